@@ -80,3 +80,44 @@ del _check_dependencies
 # This  is used in nilearn._utils.cache_mixin
 check_cache_version = True
 
+# Maximum size, in bytes, of each of the joblib caches used by nilearn.
+# When a cache grows larger, its least recently used entries are deleted.
+# None means no limit.
+# This is used in nilearn._utils.cache_mixin
+cache_bytes_limit = None
+
+# If not None, path of a JSON file in which the statistics on the use of
+# the caches (see cache_stats) are written at exit.
+# This is used in nilearn._utils.cache_mixin
+cache_stats_file = None
+
+# With memory_level='adaptive', a function is cached only if its compute
+# time, per megabyte of output, is above this threshold (in seconds). The
+# default corresponds roughly to the time needed to load a megabyte from
+# the cache.
+# This is used in nilearn._utils.cache_mixin
+cache_adaptive_threshold = 0.01
+
+# If not None, arrays of at least this size (in bytes) in the outputs of
+# cached functions are stored as .npy files, and reloaded from the cache
+# as read-only memmaps instead of being unpickled in memory.
+# This is used in nilearn._utils.cache_mixin
+cache_mmap_min_bytes = None
+
+# Maximum number of entries, and total size in bytes, of the in-memory
+# tier kept in front of the joblib caches: the outputs of cached
+# functions recently used in this process are kept in memory, and copied
+# instead of being reloaded from disk. The outputs are copied when stored
+# and when returned, so that they can be modified by the caller: the
+# in-memory tier is disabled (0) by default. For instance, 100 entries
+# and 50e6 bytes suit repeated calls with small outputs. When the
+# arguments are numbers, strings, small arrays, or images stored in files
+# or returned by cached functions, they are not hashed to find an output
+# kept in memory.
+# This is used in nilearn._utils.cache_mixin
+cache_memory_entries = 0
+cache_memory_bytes = 50e6
+
+from ._utils.cache_mixin import cache_info, cache_prune, cache_stats, \
+        cache_stats_reset
+
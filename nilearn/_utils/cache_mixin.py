@@ -6,12 +6,24 @@ Mixin for cache with joblib
 
 import warnings
 import os
+import atexit
 import shutil
+import time
+import hashlib
+import cPickle
+import errno
+import socket
+import copy
+import threading
+from collections import OrderedDict
 from distutils.version import LooseVersion
 import json
 
+import numpy as np
 import nibabel
 from sklearn.externals.joblib import Memory
+from sklearn.externals.joblib import numpy_pickle, hashing
+from sklearn.externals.joblib.func_inspect import filter_args
 
 memory_classes = (Memory, )
 
@@ -26,10 +38,1167 @@ import nilearn
 __cache_checked = dict()
 
 
+###############################################################################
+# Management of the size of the cache directories
 
-def _safe_cache(memory, func, **kwargs):
+# Name of the file, in each cache entry, holding the result of a call
+# (joblib layout)
+_OUTPUT_FILENAME = 'output.pkl'
+
+# Name of the file holding the result of a call whose large arrays are
+# stored as .npy files (see _dump_mmap_output)
+_MMAP_OUTPUT_FILENAME = 'output_mmap.pkl'
+
+# Minimal delay (in seconds) between two scans of a cache directory to
+# check its size. Between scans, the size is estimated from the entries
+# added by the current process.
+_CACHE_SCAN_DELAY = 60.
+
+# Estimated size of each cache directory: cachedir -> [size, scan_time]
+_cache_sizes = dict()
+
+
+def _joblib_cachedir(cachedir):
+    """ Return the directory where joblib stores its entries, given a
+        joblib.Memory object or the path that was given to it.
+    """
+    if isinstance(cachedir, memory_classes):
+        return cachedir.cachedir
+    joblib_dir = os.path.join(cachedir, 'joblib')
+    if os.path.isdir(joblib_dir):
+        return joblib_dir
+    return cachedir
+
+
+def _dir_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                # The file has been removed by another process
+                pass
+    return size
+
+
+def _cache_entries(cachedir):
+    """ List the entries of a joblib cache directory.
+
+    Returns
+    -------
+    entries: list of tuples
+        (path, size, last_access) for each entry (ie a cached function
+        call). last_access is given in seconds since the epoch.
+    """
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(cachedir):
+        if not (_OUTPUT_FILENAME in filenames
+                or _MMAP_OUTPUT_FILENAME in filenames):
+            continue
+        entry_name = os.path.basename(dirpath)
+        if _TMP_SUFFIX in entry_name or '.old_' in entry_name:
+            # Entry being written or removed by another process
+            del dirnames[:]
+            continue
+        # Entries do not contain other entries
+        del dirnames[:]
+        try:
+            # The modification time of the entry directory is updated
+            # each time the entry is used (see _touch_entry)
+            last_access = os.path.getmtime(dirpath)
+        except OSError:
+            # The entry has been removed by another process
+            continue
+        entries.append((dirpath, _dir_size(dirpath), last_access))
+    return entries
+
+
+def _touch_entry(path):
+    """ Mark a cache entry as recently used.
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        # The entry has been removed by another process
+        pass
+
+
+def _remove_entry(path):
+    """ Remove a cache entry, in a way robust to race conditions.
+    """
+    # We use rename + rmtree, so that other processes never see a
+    # partially deleted entry
+    tmp_path = '%s.old_%i' % (path, os.getpid())
+    try:
+        os.rename(path, tmp_path)
+    except OSError:
+        # Another process has already removed this entry
+        return False
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    return True
+
+
+def _used_cachedirs(cachedir=None):
+    if cachedir is not None:
+        return [_joblib_cachedir(cachedir)]
+    # Cache directories used in the current session
+    return sorted(__cache_checked.keys())
+
+
+def cache_info(cachedir=None):
+    """ Return information on the content of nilearn caches.
+
+    Parameters
+    ----------
+    cachedir: string or joblib.Memory, optional
+        Cache directory to inspect, as given to joblib.Memory. If None,
+        all the cache directories used during the current session are
+        inspected.
+
+    Returns
+    -------
+    info: dict
+        Dictionary with the following keys:
+
+        - 'cachedirs': list of the inspected joblib directories
+        - 'n_entries': total number of cached function calls
+        - 'size': total size of the cached function calls, in bytes
+        - 'bytes_limit': value of nilearn.cache_bytes_limit
+        - 'functions': dictionary giving, for each cached function, its
+          number of entries ('n_entries') and their size ('size').
+    """
+    cachedirs = _used_cachedirs(cachedir)
+    functions = dict()
+    n_entries = 0
+    total_size = 0
+    for this_cachedir in cachedirs:
+        for path, size, _ in _cache_entries(this_cachedir):
+            func_name = os.path.relpath(os.path.dirname(path),
+                                        this_cachedir)
+            func_info = functions.setdefault(func_name,
+                                             dict(n_entries=0, size=0))
+            func_info['n_entries'] += 1
+            func_info['size'] += size
+            n_entries += 1
+            total_size += size
+    return dict(cachedirs=cachedirs, n_entries=n_entries, size=total_size,
+                bytes_limit=nilearn.cache_bytes_limit, functions=functions)
+
+
+def cache_prune(cachedir=None, bytes_limit=None):
+    """ Remove the least recently used entries of nilearn caches.
+
+    Entries are removed, starting from the least recently used, until the
+    size of the cache is below bytes_limit.
+
+    Parameters
+    ----------
+    cachedir: string or joblib.Memory, optional
+        Cache directory to prune, as given to joblib.Memory. If None, all
+        the cache directories used during the current session are pruned.
+
+    bytes_limit: int, optional
+        Maximum size of each cache directory, in bytes. Defaults to
+        nilearn.cache_bytes_limit. If both are None, nothing is done.
+
+    Returns
+    -------
+    removed: int
+        Number of bytes freed.
+    """
+    if bytes_limit is None:
+        bytes_limit = nilearn.cache_bytes_limit
+    if bytes_limit is None:
+        return 0
+    removed = 0
+    for this_cachedir in _used_cachedirs(cachedir):
+        entries = _cache_entries(this_cachedir)
+        size = sum(entry[1] for entry in entries)
+        # Least recently used first
+        entries.sort(key=lambda entry: entry[2])
+        for path, entry_size, _ in entries:
+            if size <= bytes_limit:
+                break
+            if _remove_entry(path):
+                removed += entry_size
+            # If the removal failed, another process has removed the entry
+            size -= entry_size
+        _cache_sizes[this_cachedir] = [size, time.time()]
+    return removed
+
+
+def _register_entry(cachedir, size):
+    """ Account for a new cache entry of the given size, and prune the
+        cache if it has grown over nilearn.cache_bytes_limit.
+    """
+    bytes_limit = nilearn.cache_bytes_limit
+    if bytes_limit is None:
+        return
+    size_info = _cache_sizes.get(cachedir)
+    if (size_info is None
+            or time.time() - size_info[1] > _CACHE_SCAN_DELAY):
+        # Other processes may write in the same directory: rescan it
+        # regularly
+        size_info = [sum(entry[1] for entry in _cache_entries(cachedir)),
+                     time.time()]
+        _cache_sizes[cachedir] = size_info
+    else:
+        size_info[0] += size
+    if size_info[0] > bytes_limit:
+        cache_prune(cachedir, bytes_limit=bytes_limit)
+
+
+###############################################################################
+# Statistics on the use of the caches
+
+# Statistics for each cached function, in the current process
+_cache_stats = dict()
+
+_STAT_NAMES = ('hits', 'memory_hits', 'misses', 'compute_time',
+               'load_time', 'bytes_stored')
+
+
+def _record_call(func_name, **stats):
+    func_stats = _cache_stats.get(func_name)
+    if func_stats is None:
+        func_stats = dict((name, 0) for name in _STAT_NAMES)
+        _cache_stats[func_name] = func_stats
+    for name, value in stats.items():
+        func_stats[name] += value
+
+
+def cache_stats(func_name=None):
+    """ Return statistics on the use of nilearn caches.
+
+    The statistics are collected for each cached function, for the calls
+    made in the current process since the start of the session (or
+    the last call to cache_stats_reset).
+
+    Parameters
+    ----------
+    func_name: string, optional
+        Name of a cached function, as given by cache_stats() or
+        cache_info() (eg. 'nilearn/image/resampling/resample_img'). If
+        None, the statistics of all the functions are returned.
+
+    Returns
+    -------
+    stats: dict
+        Dictionary giving, for each cached function (or for func_name
+        only if given), a dictionary with the following entries:
+
+        - 'hits', 'misses': number of calls with and without a result
+          available in the cache
+        - 'memory_hits': number of calls with a result available in the
+          in-memory tier of the cache (not counted in 'hits')
+        - 'compute_time', 'load_time': total time (in seconds) spent
+          computing the function on misses, and loading the result from
+          the cache on hits
+        - 'bytes_stored': total size of the entries written in the cache
+        - 'time_saved': estimate of the time saved by the cache: hits
+          (from disk and memory) times the mean compute time, minus the
+          load time. A negative value means that caching this function is
+          not worth it.
+    """
+    stats = dict()
+    for this_name, func_stats in _cache_stats.items():
+        func_stats = func_stats.copy()
+        if func_stats['misses']:
+            mean_compute_time = (func_stats['compute_time']
+                                 / func_stats['misses'])
+            func_stats['time_saved'] = ((func_stats['hits']
+                                         + func_stats['memory_hits'])
+                                        * mean_compute_time
+                                        - func_stats['load_time'])
+        else:
+            func_stats['time_saved'] = None
+        stats[this_name] = func_stats
+    if func_name is not None:
+        return stats[func_name]
+    return stats
+
+
+def cache_stats_reset():
+    """ Reset the statistics on the use of nilearn caches.
+    """
+    _cache_stats.clear()
+
+
+def _dump_cache_stats():
+    """ Write the cache statistics in nilearn.cache_stats_file, if set.
+
+        This function is called at exit.
+    """
+    filename = getattr(nilearn, 'cache_stats_file', None)
+    if filename is None or not _cache_stats:
+        return
+    with open(filename, 'w') as stats_file:
+        json.dump(cache_stats(), stats_file, indent=2, sort_keys=True)
+
+
+atexit.register(_dump_cache_stats)
+
+
+###############################################################################
+# In-memory tier of the caches
+
+# Outputs recently used in this process, from the least to the most
+# recently used: key -> (output, nbytes). The key is given by
+# _CachedFunc._memory_key if the arguments have a cheap key, otherwise it
+# is the directory of the cache entry.
+_memory_cache = OrderedDict()
+
+# Total size of the outputs held by _memory_cache
+_memory_cache_size = 0
+
+# The in-memory tier may be used from several threads
+_memory_cache_lock = threading.Lock()
+
+
+def _memory_cache_get(key):
+    """ Return a copy of an output of the in-memory tier.
+
+        Returns
+        -------
+        found: boolean
+            Whether the output is in the in-memory tier.
+        output: object
+            A copy of the output, or None.
+    """
+    with _memory_cache_lock:
+        entry = _memory_cache.pop(key, None)
+        if entry is None:
+            return False, None
+        # Mark the entry as the most recently used
+        _memory_cache[key] = entry
+    # The output is copied, as callers may modify it in place
+    return True, copy.deepcopy(entry[0])
+
+
+def _memory_cache_put(key, output):
+    """ Keep a copy of an output in the in-memory tier, and remove the
+        least recently used outputs if the tier is full.
+    """
+    global _memory_cache_size
+    max_entries = nilearn.cache_memory_entries
+    max_bytes = nilearn.cache_memory_bytes
+    if not max_entries or not max_bytes:
+        return
+    nbytes = _nbytes(output)
+    if nbytes > max_bytes:
+        return
+    output = copy.deepcopy(output)
+    with _memory_cache_lock:
+        entry = _memory_cache.pop(key, None)
+        if entry is not None:
+            _memory_cache_size -= entry[1]
+        _memory_cache[key] = (output, nbytes)
+        _memory_cache_size += nbytes
+        while (len(_memory_cache) > max_entries
+                or _memory_cache_size > max_bytes):
+            _, (_, entry_nbytes) = _memory_cache.popitem(last=False)
+            _memory_cache_size -= entry_nbytes
+
+
+def _memory_cache_clear():
+    global _memory_cache_size
+    with _memory_cache_lock:
+        _memory_cache.clear()
+        _memory_cache_size = 0
+
+
+###############################################################################
+# Adaptive caching policy
+
+# Name of the file, in each cache directory, storing the costs measured
+# for the adaptive policy
+_ADAPTIVE_STATS_FILENAME = 'adaptive_stats.json'
+
+# Number of calls for which a function is always cached, to measure its
+# cost, before the adaptive policy applies.
+_ADAPTIVE_MIN_CALLS = 3
+
+# Number of calls after which the costs measured are written in the cache
+# directory (they are also written at exit)
+_ADAPTIVE_FLUSH_CALLS = 100
+
+# Costs measured for the adaptive policy: for each cache directory,
+# dictionary giving for each function [n_calls, compute_time, nbytes]
+_adaptive_stats = dict()
+
+# Costs measured since the last write in the cache directory, in the same
+# format
+_adaptive_pending = dict()
+
+_adaptive_lock = threading.Lock()
+
+
+def _nbytes(obj):
+    """ Estimate the size of the arrays held by an object, in bytes.
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(_nbytes(o) for o in obj.values())
+    # In-memory data of nibabel images
+    data = getattr(obj, '_data_cache', None)
+    if data is None:
+        data = getattr(obj, 'dataobj', getattr(obj, '_data', None))
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    return 0
+
+
+def _load_adaptive_stats(cachedir):
+    stats = _adaptive_stats.get(cachedir)
+    if stats is None:
+        stats_file = os.path.join(cachedir, _ADAPTIVE_STATS_FILENAME)
+        try:
+            with open(stats_file, 'r') as stats_file:
+                stats = json.load(stats_file)
+        except (IOError, ValueError):
+            # No statistics yet, or a file being written by another process
+            stats = dict()
+        _adaptive_stats[cachedir] = stats
+    return stats
+
+
+def _update_adaptive_stats(cachedir, func_name, compute_time, nbytes):
+    """ Record the cost of a call.
+
+        The costs are persisted in the cache directory every
+        _ADAPTIVE_FLUSH_CALLS calls and at exit, not to add disk accesses
+        to the calls that are not cached.
+    """
+    with _adaptive_lock:
+        stats = _load_adaptive_stats(cachedir)
+        pending = _adaptive_pending.setdefault(cachedir, dict())
+        for func_stats in (stats.setdefault(func_name, [0, 0., 0]),
+                           pending.setdefault(func_name, [0, 0., 0])):
+            func_stats[0] += 1
+            func_stats[1] += compute_time
+            func_stats[2] += nbytes
+        n_pending = sum(func_stats[0] for func_stats in pending.values())
+    if n_pending >= _ADAPTIVE_FLUSH_CALLS:
+        _flush_adaptive_stats(cachedir)
+
+
+def _flush_adaptive_stats(cachedir=None):
+    """ Add the costs recorded since the last flush to the costs stored in
+        the cache directory (all the directories if cachedir is None).
+
+        This function is called at exit.
+    """
+    with _adaptive_lock:
+        cachedirs = (list(_adaptive_pending) if cachedir is None
+                     else [cachedir])
+        for cachedir in cachedirs:
+            pending = _adaptive_pending.pop(cachedir, None)
+            if not pending:
+                continue
+            # Read the file again, to keep the updates made by other
+            # processes since we loaded it
+            _adaptive_stats.pop(cachedir, None)
+            stats = _load_adaptive_stats(cachedir)
+            for func_name, pending_stats in pending.items():
+                func_stats = stats.setdefault(func_name, [0, 0., 0])
+                for i, value in enumerate(pending_stats):
+                    func_stats[i] += value
+            # Write to a temporary file and rename it, so that concurrent
+            # processes never read a partially written file. Updates
+            # written by other processes between our read and our rename
+            # are lost: this only delays the convergence of the
+            # statistics.
+            stats_file = os.path.join(cachedir, _ADAPTIVE_STATS_FILENAME)
+            tmp_file = '%s.%i' % (stats_file, os.getpid())
+            try:
+                with open(tmp_file, 'w') as tmp:
+                    json.dump(stats, tmp)
+                os.rename(tmp_file, stats_file)
+            except (IOError, OSError):
+                pass
+
+
+atexit.register(_flush_adaptive_stats)
+
+
+def _worth_caching(cachedir, func_name):
+    """ Decide, from the measured costs of a function, whether caching its
+        calls is worth it.
+
+        A function is cached if the time needed to compute it, per
+        megabyte of output, is above nilearn.cache_adaptive_threshold.
+    """
+    func_stats = _load_adaptive_stats(cachedir).get(func_name)
+    if func_stats is None or func_stats[0] < _ADAPTIVE_MIN_CALLS:
+        # Not enough measures yet
+        return True
+    n_calls, compute_time, nbytes = func_stats
+    if nbytes == 0:
+        return True
+    return (compute_time / (nbytes / 1.e6)
+            >= nilearn.cache_adaptive_threshold)
+
+
+###############################################################################
+# Concurrent access to the cache entries
+
+# Suffix of the lock file of a cache entry, held by the process computing
+# the entry
+_LOCK_SUFFIX = '.lock'
+
+# Suffix of the temporary directories in which the entries are written
+_TMP_SUFFIX = '.tmp_'
+
+# Delay (in seconds) between two checks, by a process waiting for an
+# entry computed by another process
+_LOCK_POLL_DELAY = .1
+
+# Delay (in seconds) between two updates of the modification time of a
+# lock, by the process holding it
+_LOCK_REFRESH_DELAY = 60.
+
+# Age (in seconds, since its last update) after which a lock held by a
+# process on another host is considered stale: we cannot check that
+# this process is alive
+_LOCK_TIMEOUT = 10 * _LOCK_REFRESH_DELAY
+
+
+def _acquire_lock(lock_filename):
+    """ Try to create the lock file of a cache entry.
+
+        Returns True if the lock was acquired.
+    """
+    try:
+        # O_EXCL makes the creation atomic, also on NFS v3 and later
+        fd = os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    try:
+        os.write(fd, '%s %i' % (socket.gethostname(), os.getpid()))
+    finally:
+        os.close(fd)
+    return True
+
+
+def _release_lock(lock_filename):
+    try:
+        os.unlink(lock_filename)
+    except OSError:
+        # The lock has been removed as stale by another process
+        pass
+
+
+def _refresh_lock(lock_filename, stop):
+    """ Update the modification time of a lock every _LOCK_REFRESH_DELAY,
+        until the stop event is set, so that the lock of a long
+        computation is not taken for a stale one by other hosts.
+    """
+    while not stop.wait(_LOCK_REFRESH_DELAY):
+        try:
+            os.utime(lock_filename, None)
+        except OSError:
+            # The lock has been released
+            return
+
+
+def _start_lock_refresh(lock_filename):
+    """ Refresh a lock in a background thread (see _refresh_lock).
+
+        Returns the event stopping the refresh.
+    """
+    stop = threading.Event()
+    thread = threading.Thread(target=_refresh_lock,
+                              args=(lock_filename, stop))
+    thread.daemon = True
+    thread.start()
+    return stop
+
+
+def _lock_is_stale(lock_filename):
+    """ Whether the process holding a lock has died or, for a process on
+        another host, whether the lock has not been refreshed for
+        _LOCK_TIMEOUT.
+    """
+    try:
+        with open(lock_filename, 'r') as lock_file:
+            hostname, pid = lock_file.read().split()
+        lock_time = os.path.getmtime(lock_filename)
+    except (IOError, OSError, ValueError):
+        # The lock has been released, or is being written
+        return False
+    if hostname != socket.gethostname():
+        return time.time() - lock_time > _LOCK_TIMEOUT
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def _wait_for_lock(lock_filename, done=None):
+    """ Acquire a lock, waiting for the process holding it.
+
+        Parameters
+        ----------
+        lock_filename: string
+            Path of the lock file.
+        done: callable, optional
+            Called while waiting. If it returns True, the wait is
+            interrupted.
+
+        Returns
+        -------
+        acquired: boolean
+            False if the wait has been interrupted by done.
+    """
+    while not _acquire_lock(lock_filename):
+        if _lock_is_stale(lock_filename):
+            # If several processes detect a stale lock at the same time,
+            # a fresh lock may be removed: this can only lead to computing
+            # an entry twice, as entries are written atomically.
+            _release_lock(lock_filename)
+            continue
+        time.sleep(_LOCK_POLL_DELAY)
+        if done is not None and done():
+            return False
+    return True
+
+
+###############################################################################
+# Storage of large arrays as memmappable .npy files
+
+def _dump_mmap_output(output, output_dir, min_bytes):
+    """ Store the output of a call, writing the arrays larger than
+        min_bytes as .npy files.
+
+        The rest of the output is pickled in a small file, in which the
+        arrays are replaced by the names of their .npy files.
+
+        Returns
+        -------
+        dumped: boolean
+            False if the output holds no large array, in which case nothing
+            is written.
+    """
+    array_names = dict()
+    arrays = []
+
+    def persistent_id(obj):
+        # Subclasses of ndarray (eg masked arrays) are pickled as usual
+        if (type(obj) not in (np.ndarray, np.memmap)
+                or obj.dtype.hasobject or obj.nbytes < min_bytes):
+            return None
+        name = array_names.get(id(obj))
+        if name is None:
+            name = 'array_%i.npy' % len(arrays)
+            array_names[id(obj)] = name
+            arrays.append((name, obj))
+        return name
+
+    with open(os.devnull, 'wb') as devnull:
+        # First pass to find the large arrays
+        pickler = cPickle.Pickler(devnull, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(output)
+    if not arrays:
+        return False
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for name, array in arrays:
+        np.save(os.path.join(output_dir, name), array)
+    # The pickle is written last: an entry is complete once it exists
+    filename = os.path.join(output_dir, _MMAP_OUTPUT_FILENAME)
+    with open(filename, 'wb') as output_file:
+        pickler = cPickle.Pickler(output_file, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump(output)
+    return True
+
+
+def _load_mmap_output(output_dir, mmap_mode='r'):
+    """ Load an output stored by _dump_mmap_output, the large arrays being
+        memmapped.
+    """
+    def persistent_load(name):
+        return np.load(os.path.join(output_dir, name), mmap_mode=mmap_mode)
+
+    with open(os.path.join(output_dir, _MMAP_OUTPUT_FILENAME),
+              'rb') as output_file:
+        unpickler = cPickle.Unpickler(output_file)
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+
+###############################################################################
+# Cheap keys for the arguments of cached functions
+
+def _header_hash(niimg):
+    """ Hash of the header and affine of a niimg (a few hundred bytes).
+    """
+    header = niimg.get_header()
+    md5 = hashlib.md5(header.binaryblock)
+    md5.update(niimg.get_affine().tostring())
+    return md5.hexdigest()
+
+
+def _data_handed_out(niimg):
+    """ Whether get_data has returned a writable array of a niimg, which
+        may thus have been modified in place.
+    """
+    data = getattr(niimg, '_data_cache', True)
+    if data is None:
+        return False
+    return not (isinstance(data, np.ndarray) and not data.flags.writeable)
+
+
+def _release_data(niimg):
+    """ Forget that get_data returned the data of an in-memory niimg.
+
+        Nothing is freed: the data remains held by the data object.
+    """
+    if getattr(niimg, '_data_cache', None) is getattr(niimg, '_dataobj',
+                                                      False):
+        niimg._data_cache = None
+
+
+# Arrays larger than this are not given a cheap key (see _cheap_key)
+_CHEAP_KEY_MAX_BYTES = 10000
+
+
+class _NoCheapKey(Exception):
+    """ Raised by _cheap_key for objects that must be hashed by joblib.
+    """
+
+
+def _cheap_key(obj):
+    """ Hashable key identifying an argument of a cached function, computed
+        without hashing its content: numbers, strings, small arrays, and
+        the images given a key by _cache_key, possibly nested in lists,
+        tuples or dicts.
+
+        Raises _NoCheapKey for other objects.
+    """
+    if obj is None or isinstance(obj, (bool, int, long, float, complex,
+                                       np.number)):
+        # The type is part of the key, as 1 == 1. == True
+        return type(obj).__name__, obj
+    if isinstance(obj, basestring):
+        return type(obj).__name__, _cache_key(obj)
+    if isinstance(obj, (list, tuple)):
+        return type(obj).__name__, tuple(_cheap_key(o) for o in obj)
+    if isinstance(obj, dict):
+        return 'dict', frozenset((_cheap_key(k), _cheap_key(v))
+                                 for k, v in obj.items())
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject or obj.nbytes > _CHEAP_KEY_MAX_BYTES:
+            raise _NoCheapKey()
+        return 'ndarray', obj.dtype.str, obj.shape, obj.tostring()
+    key = _cache_key(obj)
+    if key is obj:
+        raise _NoCheapKey()
+    return key
+
+
+def _iter_niimgs(obj):
+    """ Iterate over the nibabel images in obj, possibly nested in lists,
+        tuples or dicts.
+    """
+    if isinstance(obj, (list, tuple)):
+        for o in obj:
+            for niimg in _iter_niimgs(o):
+                yield niimg
+    elif isinstance(obj, dict):
+        for o in obj.values():
+            for niimg in _iter_niimgs(o):
+                yield niimg
+    elif hasattr(obj, 'get_header') and hasattr(obj, 'get_affine'):
+        yield obj
+
+
+def _file_key(filename):
+    """ Key identifying the content of a file, without reading it.
+    """
+    stat = os.stat(filename)
+    return (os.path.realpath(filename), stat.st_size, stat.st_mtime)
+
+
+def _cache_key(obj):
+    """ Replace, in the arguments of a cached function, the objects that
+        are costly to hash by small keys identifying their content.
+
+        - nibabel images backed by a file, the data of which has not been
+          loaded, are identified by the file path, size and modification
+          time, and a hash of their header.
+        - images returned by cached functions are identified by their
+          provenance (the cached function and the key of its arguments),
+          without reading their data, as long as get_data has not
+          returned their data outside of cached functions. Otherwise, the
+          data may have been modified in place: the provenance is
+          forgotten and the image is hashed as usual.
+        - paths to existing files are identified by the file path, size
+          and modification time.
+
+        Other objects are returned unchanged, and are hashed by joblib.
+    """
+    if isinstance(obj, basestring):
+        if os.path.isfile(obj):
+            return ('file', obj) + _file_key(obj)
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cache_key(o) for o in obj)
+    if isinstance(obj, dict):
+        return dict((k, _cache_key(v)) for k, v in obj.items())
+    if hasattr(obj, 'get_header') and hasattr(obj, 'get_affine'):
+        try:
+            provenance = getattr(obj, '_nilearn_provenance', None)
+            if provenance is not None:
+                if not _data_handed_out(obj):
+                    return (('derived', ) + provenance
+                            + (_header_hash(obj), ))
+                del obj._nilearn_provenance
+            filename = obj.get_filename()
+            if (filename is not None
+                    and getattr(obj, '_data_cache', True) is None
+                    and os.path.isfile(filename)):
+                return (('niimg', obj.__class__.__name__)
+                        + _file_key(filename) + (_header_hash(obj), ))
+        except Exception:
+            # Not a nibabel image: use the default hashing
+            pass
+    return obj
+
+
+def _set_provenance(output, provenance, inputs=()):
+    """ Record, on the images returned by a cached function, which call
+        produced them.
+
+        Images that were given as inputs (in the inputs list, possibly
+        nested in lists, tuples or dicts) are not modified.
+    """
+    input_ids = set()
+    to_visit = list(inputs)
+    while to_visit:
+        input_ = to_visit.pop()
+        if id(input_) in input_ids:
+            continue
+        input_ids.add(id(input_))
+        if isinstance(input_, (list, tuple)):
+            to_visit.extend(input_)
+        elif isinstance(input_, dict):
+            to_visit.extend(input_.values())
+
+    def set_provenance(output):
+        if id(output) in input_ids:
+            return
+        if isinstance(output, (list, tuple)):
+            for this_output in output:
+                set_provenance(this_output)
+        elif hasattr(output, 'get_header') and hasattr(output, 'get_affine'):
+            try:
+                output._nilearn_provenance = provenance
+            except AttributeError:
+                return
+            _release_data(output)
+
+    set_provenance(output)
+
+
+class _CachedFunc(object):
+    """ Callable object wrapping a joblib MemorizedFunc.
+
+    It behaves as the MemorizedFunc, with the following differences:
+
+    - the arguments are hashed only once, using cheap keys for the
+      images stored in files and the images computed by cached functions
+      (see _cache_key).
+    - it keeps track of the use of the cache entries, so that the least
+      recently used entries can be removed (see cache_prune).
+    - if adaptive is True, calls are cached only if the function is
+      costly to compute compared to the size of its output (see
+      _worth_caching).
+    - if nilearn.cache_mmap_min_bytes is set, the large arrays of the
+      outputs are stored as .npy files and reloaded as memmaps (see
+      _dump_mmap_output).
+    - it is safe to use from concurrent processes: entries are written
+      atomically, and each entry is computed by a single process, the
+      others waiting for it (see _acquire_lock).
+    - if nilearn.cache_memory_entries is set, the outputs recently used
+      are kept in memory, in front of the disk cache (see
+      _memory_cache_get).
+    """
+
+    def __init__(self, memorized_func, adaptive=False):
+        self.memorized_func = memorized_func
+        self.adaptive = adaptive
+        self._func_code_checked = False
+        self._func_dir = None
+        self._func_name = None
+
+    def _get_output_dir(self, *args, **kwargs):
+        """ Return the directory of the cache entry for the given arguments
+            and the hash of the arguments.
+        """
+        memorized_func = self.memorized_func
+        arguments = filter_args(memorized_func.func, memorized_func.ignore,
+                                args, kwargs)
+        argument_hash = hashing.hash(
+            _cache_key(arguments),
+            coerce_mmap=(memorized_func.mmap_mode is not None))
+        output_dir = os.path.join(memorized_func._get_func_dir(),
+                                  argument_hash)
+        return output_dir, argument_hash
+
+    def _memory_key(self, args, kwargs):
+        """ Key of the in-memory tier for the given arguments, which can be
+            looked up before hashing them (see _cheap_key).
+
+            None if the in-memory tier is disabled, or if the arguments
+            have no cheap key.
+
+            The arguments are not matched with the signature of the
+            function (filter_args costs more than the lookup): the same
+            arguments given positionally or by name have different keys.
+        """
+        if not nilearn.cache_memory_entries or not nilearn.cache_memory_bytes:
+            return None
+        try:
+            key = _cheap_key((args, kwargs))
+        except _NoCheapKey:
+            return None
+        if self._func_dir is None:
+            self._func_dir = self.memorized_func._get_func_dir(mkdir=False)
+        return self._func_dir, key
+
+    def _memory_get(self, memory_key):
+        """ Return the output kept in the in-memory tier, if any.
+        """
+        t0 = time.time()
+        found, output = _memory_cache_get(memory_key)
+        if found:
+            _record_call(self.func_name, memory_hits=1,
+                         load_time=time.time() - t0)
+        return found, output
+
+    @property
+    def func_name(self):
+        """ Name of the function, relative to the cache directory.
+        """
+        if self._func_name is None:
+            memorized_func = self.memorized_func
+            self._func_name = os.path.relpath(
+                memorized_func._get_func_dir(mkdir=False),
+                memorized_func.cachedir)
+        return self._func_name
+
+    def _check_func_code(self):
+        """ Check that the code of the function has not changed since the
+            entries were stored.
+        """
+        memorized_func = self.memorized_func
+        if self._func_code_checked:
+            # joblib keeps the hash of the code in memory: no disk access
+            func_code_ok = memorized_func._check_previous_func_code(
+                stacklevel=4)
+        else:
+            # The first check may write the code of the function, or clear
+            # the cache of the function: it must not run concurrently with
+            # the check of another process, which would read a partially
+            # written file and clear the cache.
+            lock_filename = memorized_func._get_func_dir() + _LOCK_SUFFIX
+            _wait_for_lock(lock_filename)
+            try:
+                func_code_ok = memorized_func._check_previous_func_code(
+                    stacklevel=4)
+            finally:
+                _release_lock(lock_filename)
+            self._func_code_checked = True
+        if not func_code_ok:
+            # The outputs kept in memory are outdated as well
+            _memory_cache_clear()
+        return func_code_ok
+
+    def _load_output(self, output_dir, memory_key):
+        """ Load the output stored in a cache entry, if it exists, and keep
+            it in the in-memory tier under memory_key (or output_dir if
+            None).
+
+        Returns
+        -------
+        found: boolean
+            Whether the entry could be loaded.
+        output: object
+            The output of the function, or None.
+        """
+        memorized_func = self.memorized_func
+        filename = os.path.join(output_dir, _OUTPUT_FILENAME)
+        mmap_filename = os.path.join(output_dir, _MMAP_OUTPUT_FILENAME)
+        if not (os.path.exists(mmap_filename) or os.path.exists(filename)):
+            return False, None
+        try:
+            t0 = time.time()
+            if os.path.exists(mmap_filename):
+                output = _load_mmap_output(
+                    output_dir, memorized_func.mmap_mode or 'r')
+            else:
+                output = numpy_pickle.load(
+                    filename, mmap_mode=memorized_func.mmap_mode)
+        except Exception:
+            # The entry may have been removed or corrupted by another
+            # process: recompute it
+            return False, None
+        _record_call(self.func_name, hits=1, load_time=time.time() - t0)
+        _touch_entry(output_dir)
+        self._keep_in_memory(output, output_dir, memory_key)
+        return True, output
+
+    def _keep_in_memory(self, output, output_dir, memory_key):
+        """ Put an output in the in-memory tier, unless it is memmapped
+            from the disk cache, and thus cheap to reload.
+        """
+        if (self.memorized_func.mmap_mode is None
+                and not os.path.exists(os.path.join(output_dir,
+                                                    _MMAP_OUTPUT_FILENAME))):
+            _memory_cache_put(memory_key or output_dir, output)
+
+    def _release_inputs(self, derived_inputs, output):
+        """ Forget that the data of the derived input images was handed
+            out by the function, unless it is shared with the output, which
+            may be modified in place.
+        """
+        output_data = [getattr(niimg, '_dataobj', None)
+                       for niimg in _iter_niimgs([output])]
+        for niimg in derived_inputs:
+            data = getattr(niimg, '_dataobj', None)
+            if isinstance(data, np.ndarray) and any(
+                    np.may_share_memory(data, o) for o in output_data
+                    if isinstance(o, np.ndarray)):
+                del niimg._nilearn_provenance
+            else:
+                _release_data(niimg)
+
+    def _persist_output(self, output, output_dir):
+        """ Store an output in a cache entry, atomically: the entry is
+            written in a temporary directory, which is then renamed.
+        """
+        tmp_dir = '%s%s%s_%i' % (output_dir, _TMP_SUFFIX,
+                                 socket.gethostname(), os.getpid())
+        min_bytes = nilearn.cache_mmap_min_bytes
+        if (min_bytes is None
+                or not _dump_mmap_output(output, tmp_dir, min_bytes)):
+            self.memorized_func._persist_output(output, tmp_dir)
+        size = _dir_size(tmp_dir)
+        if os.path.exists(output_dir):
+            # Incomplete entry, left by an interrupted process, or entry
+            # stored by another process that did not wait for our lock
+            _remove_entry(output_dir)
+        try:
+            os.rename(tmp_dir, output_dir)
+        except OSError:
+            # Another process has stored this entry meanwhile
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return size
+
+    def __call__(self, *args, **kwargs):
+        memorized_func = self.memorized_func
+        func_name = self.func_name
+        cachedir = memorized_func.cachedir
+        if self.adaptive and not _worth_caching(cachedir, func_name):
+            # Cheaper to recompute than to store and load
+            t0 = time.time()
+            output = memorized_func.func(*args, **kwargs)
+            _update_adaptive_stats(cachedir, func_name, time.time() - t0,
+                                   _nbytes(output))
+            return output
+        # The in-memory tier is looked up before hashing the arguments,
+        # when they have a cheap key
+        memory_key = self._memory_key(args, kwargs)
+        if memory_key is not None and self._check_func_code():
+            found, output = self._memory_get(memory_key)
+            if found:
+                return output
+        output_dir, argument_hash = self._get_output_dir(*args, **kwargs)
+        if self._check_func_code():
+            if memory_key is None:
+                found, output = self._memory_get(output_dir)
+                if found:
+                    return output
+            found, output = self._load_output(output_dir, memory_key)
+            if found:
+                return output
+
+        # Compute once, other processes wait: the process computing an
+        # entry holds its lock.
+        lock_filename = output_dir + _LOCK_SUFFIX
+        loaded = []
+
+        def entry_stored():
+            found, output = self._load_output(output_dir, memory_key)
+            if found:
+                loaded.append(output)
+            return found
+
+        if not _wait_for_lock(lock_filename, done=entry_stored):
+            return loaded[0]
+        stop_refresh = _start_lock_refresh(lock_filename)
+        try:
+            # The entry may have been stored while we were waiting
+            found, output = self._load_output(output_dir, memory_key)
+            if found:
+                return output
+            inputs = args + tuple(kwargs.values())
+            # Derived images keep their provenance key if the function
+            # only reads their data
+            derived_inputs = [
+                niimg for niimg in _iter_niimgs(inputs)
+                if hasattr(niimg, '_nilearn_provenance')
+                and not _data_handed_out(niimg)]
+            t0 = time.time()
+            output = memorized_func.func(*args, **kwargs)
+            compute_time = time.time() - t0
+            self._release_inputs(derived_inputs, output)
+            # The provenance is stored with the output, and thus also set
+            # on outputs loaded from the cache
+            _set_provenance(output, (func_name, argument_hash),
+                            inputs=inputs)
+            size = self._persist_output(output, output_dir)
+        finally:
+            stop_refresh.set()
+            _release_lock(lock_filename)
+        self._keep_in_memory(output, output_dir, memory_key)
+        _record_call(func_name, misses=1, compute_time=compute_time,
+                     bytes_stored=size)
+        if self.adaptive:
+            # Same measure of the size as for the calls not cached
+            _update_adaptive_stats(cachedir, func_name, compute_time,
+                                   _nbytes(output))
+        _register_entry(cachedir, size)
+        return output
+
+    def __getattr__(self, name):
+        # Give access to the attributes of the MemorizedFunc (func, clear...)
+        if name == 'memorized_func':
+            raise AttributeError(name)
+        return getattr(self.memorized_func, name)
+
+    def __reduce__(self):
+        return (self.__class__, (self.memorized_func, self.adaptive))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.memorized_func)
+
+
+def _safe_cache(memory, func, adaptive=False, **kwargs):
     """ A wrapper for mem.cache that flushes the cache if the version
         number of nibabel has changed.
+
+        If adaptive is True, the calls are cached according to their
+        measured cost (see _CachedFunc).
     """
     cachedir = memory.cachedir
     if cachedir is not None and not cachedir in __cache_checked:
@@ -91,7 +1260,10 @@ def _safe_cache(memory, func, **kwargs):
 
         __cache_checked[cachedir] = True
 
-    return memory.cache(func, **kwargs)
+    memorized_func = memory.cache(func, **kwargs)
+    if cachedir is None:
+        return memorized_func
+    return _CachedFunc(memorized_func, adaptive=adaptive)
 
 
 def cache(func, memory, ref_memory_level=2, memory_level=1, **kwargs):
@@ -111,10 +1283,12 @@ def cache(func, memory, ref_memory_level=2, memory_level=1, **kwargs):
     memory: instance of joblib.Memory or string
         Used to cache the function call.
 
-    ref_memory_level: int
+    ref_memory_level: int or 'adaptive'
         The reference memory_level used to determine if function call must
         be cached or not (if memory_level is larger than ref_memory_level
-        the function is cached)
+        the function is cached). If 'adaptive', memory_level is ignored:
+        the function is cached if its measured compute time per megabyte
+        of output is above nilearn.cache_adaptive_threshold.
 
     memory_level: int
         The memory_level from which caching must be enabled for the wrapped
@@ -132,7 +1306,8 @@ def cache(func, memory, ref_memory_level=2, memory_level=1, **kwargs):
         returned.
     """
 
-    if ref_memory_level <= memory_level or memory is None:
+    adaptive = (ref_memory_level == 'adaptive')
+    if (not adaptive and ref_memory_level <= memory_level) or memory is None:
         memory = Memory(cachedir=None)
     else:
         memory = memory
@@ -143,13 +1318,13 @@ def cache(func, memory, ref_memory_level=2, memory_level=1, **kwargs):
                             "joblib.Memory object. "
                             "%s %s was given." % (memory, type(memory)))
         if memory.cachedir is None:
-            warnings.warn("Caching has been enabled (memory_level = %d) "
+            warnings.warn("Caching has been enabled (memory_level = %s) "
                           "but no Memory object or path has been provided"
                           " (parameter memory). Caching deactivated for "
                           "function %s." %
                           (ref_memory_level, func.func_name),
                           stacklevel=2)
-    return _safe_cache(memory, func, **kwargs)
+    return _safe_cache(memory, func, adaptive=adaptive, **kwargs)
 
 
 class CacheMixin(object):
@@ -162,6 +1337,10 @@ class CacheMixin(object):
     defined by this class. Caching is performed only if the user-specified
     cache level (self._memory_level) is greater than the value given as a
     parameter to self._cache(). See _cache() documentation for details.
+
+    If self.memory_level is 'adaptive', the caching level is ignored: the
+    functions are cached depending on their measured cost (compute time
+    per megabyte of output, compared to nilearn.cache_adaptive_threshold).
     """
 
     def _cache(self, func, memory_level=1, **kwargs):
@@ -209,7 +1388,8 @@ class CacheMixin(object):
                 self.memory_level = 1
         verbose = getattr(self, 'verbose', 0)
 
-        if self.memory_level < memory_level:
+        adaptive = (self.memory_level == 'adaptive')
+        if not adaptive and self.memory_level < memory_level:
             memory = Memory(cachedir=None, verbose=verbose)
             return _safe_cache(memory, func, **kwargs)
         else:
@@ -220,9 +1400,9 @@ class CacheMixin(object):
                 raise TypeError("'memory' argument must be a string or a "
                                 "joblib.Memory object.")
             if memory.cachedir is None:
-                warnings.warn("Caching has been enabled (memory_level = %d) "
+                warnings.warn("Caching has been enabled (memory_level = %s) "
                               "but no Memory object or path has been provided"
                               " (parameter memory). Caching deactivated for "
                               "function %s." %
                               (self.memory_level, func.func_name))
-            return _safe_cache(memory, func, **kwargs)
+            return _safe_cache(memory, func, adaptive=adaptive, **kwargs)
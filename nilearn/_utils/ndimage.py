@@ -12,6 +12,106 @@ from scipy import ndimage
 # Operating on connected components
 ###############################################################################
 
+def nonzero_bounding_box(volume):
+    """Return the bounding box of the non-zero values of an array.
+
+    The bounding box is found from projections of the array: only the
+    projection on all axes but the last one is computed on the whole
+    array, the extent along the last axis is then found within the
+    bounding box of this projection.
+
+    Parameters
+    -----------
+    volume: numpy.array
+        N-dimensional array, typically 3D.
+
+    Returns
+    --------
+    slices: tuple of slices
+        Slices of the bounding box, or None if all values are zero.
+    """
+    volume = np.asarray(volume)
+    if volume.ndim == 1:
+        box = ()
+    else:
+        box = nonzero_bounding_box(np.any(volume, axis=-1))
+        if box is None:
+            return None
+    last_axis = np.where(np.any(volume[box],
+                                axis=tuple(range(volume.ndim - 1))))[0]
+    if len(last_axis) == 0:
+        return None
+    return box + (slice(last_axis[0], last_axis[-1] + 1), )
+
+
+def _label(volume):
+    """Label the connected components of an array, within the bounding
+    box of its non-zero values.
+
+    Returns the labels in the bounding box, the number of components and
+    the bounding box (None if there is no component).
+    """
+    box = nonzero_bounding_box(volume)
+    if box is None:
+        return None, 0, None
+    labels, label_nb = ndimage.label(volume[box])
+    return labels, label_nb, box
+
+
+def connected_components(volume):
+    """Label the connected components of a 3D array and compute their
+    statistics.
+
+    The components are labeled in one pass on the bounding box of the
+    non-zero values of the array, and their sizes, bounding boxes and
+    centroids are computed at once from the labels of the non-zero
+    voxels.
+
+    Parameters
+    -----------
+    volume: numpy.array
+        3D boolean array indicating a volume.
+
+    Returns
+    --------
+    labels: numpy.array
+        3D integer array of the same shape as volume: 0 outside of the
+        components, and from 1 to n_components on the components.
+
+    sizes: numpy.array
+        Number of voxels of each component, of shape (n_components, ).
+
+    slices: list of tuples of slices
+        Bounding box of each component.
+
+    centroids: numpy.array
+        Center of mass of each component, in voxels, of shape
+        (n_components, 3).
+    """
+    volume = np.asarray(volume)
+    labels_box, label_nb, box = _label(volume)
+    labels = np.zeros(volume.shape, dtype=np.int32)
+    if not label_nb:
+        return (labels, np.zeros(0, dtype=np.intp), [],
+                np.zeros((0, volume.ndim)))
+    labels[box] = labels_box
+
+    indices = np.flatnonzero(labels_box)
+    component = labels_box.ravel()[indices]
+    sizes = np.bincount(component, minlength=label_nb + 1)[1:]
+    offset = np.array([s.start for s in box])
+    coords = np.unravel_index(indices, labels_box.shape)
+    centroids = np.array([np.bincount(component, weights=axis_coords,
+                                      minlength=label_nb + 1)[1:]
+                          for axis_coords in coords]).T
+    centroids /= sizes[:, np.newaxis]
+    centroids += offset
+    slices = [tuple(slice(s.start + o, s.stop + o)
+                    for s, o in zip(component_slices, offset))
+              for component_slices in ndimage.find_objects(labels_box)]
+    return labels, sizes, slices, centroids
+
+
 def largest_connected_component(volume):
     """Return the largest connected component of a 3D array.
 
@@ -27,14 +127,14 @@ def largest_connected_component(volume):
     """
     # We use asarray to be able to work with masked arrays.
     volume = np.asarray(volume)
-    labels, label_nb = ndimage.label(volume)
+    labels, label_nb, box = _label(volume)
     if not label_nb:
         raise ValueError('No non-zero values: no connected components')
     if label_nb == 1:
         return volume.astype(np.bool)
-    label_count = np.bincount(labels.ravel().astype(np.int))
+    label_count = np.bincount(labels.ravel())
     # discard the 0 label
     label_count[0] = 0
-    return labels == label_count.argmax()
-
-
+    largest = np.zeros(volume.shape, dtype=np.bool)
+    largest[box] = labels == label_count.argmax()
+    return largest
@@ -152,6 +152,272 @@ def check_niimg(niimg):
     return result
 
 
+class _ScaledArrayProxy(object):
+    """ Array-like object storing unscaled values and per-volume scaling
+
+    The values are kept in their stored dtype (typically a small integer
+    type), along with one slope and one intercept per volume (last
+    dimension). Scaling is applied only when the array is accessed, so
+    that it can be fused with the type conversion and restricted to
+    the voxels that are actually used (see _unscaled_data).
+
+    This object follows the nibabel array proxy API, and can thus be
+    given as data to a nibabel.Nifti1Image.
+    """
+    is_proxy = True
+
+    def __init__(self, unscaled, slopes, inters, dtype=np.float32):
+        self._unscaled = unscaled
+        self.slopes = np.asarray(slopes, dtype=dtype)
+        self.inters = np.asarray(inters, dtype=dtype)
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self._unscaled.shape
+
+    @property
+    def ndim(self):
+        return self._unscaled.ndim
+
+    def get_unscaled(self):
+        return self._unscaled
+
+    def _scaling_arrays(self):
+        # Views of the slopes and intercepts broadcasted to the full shape
+        # of the array (zero strides): they can be indexed with the same
+        # slicer as the data.
+        shape = self._unscaled.shape
+        strides = (0, ) * (len(shape) - 1)
+        slopes = np.lib.stride_tricks.as_strided(
+            self.slopes, shape=shape, strides=strides + self.slopes.strides)
+        inters = np.lib.stride_tricks.as_strided(
+            self.inters, shape=shape, strides=strides + self.inters.strides)
+        return slopes, inters
+
+    def __getitem__(self, slicer):
+        slopes, inters = self._scaling_arrays()
+        data = np.array(self._unscaled[slicer], dtype=self.dtype)
+        data *= slopes[slicer]
+        data += inters[slicer]
+        return data
+
+    def __array__(self, dtype=None):
+        data = np.array(self._unscaled, dtype=self.dtype, order="F")
+        data *= self.slopes
+        data += self.inters
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    def __deepcopy__(self, memo):
+        # The proxy is never modified in place: no need to duplicate the
+        # (potentially large) stored array
+        return self
+
+
+class _VolumesProxy(object):
+    """ Array-like object giving a subset of the volumes of a 4D array
+
+    The volumes are read from the underlying array or array proxy only
+    when the data is accessed, and only the selected volumes are read:
+    slicing the proxy along the last dimension reads only the
+    corresponding volumes.
+
+    This object follows the nibabel array proxy API, and can thus be
+    given as data to a nibabel.Nifti1Image.
+    """
+    is_proxy = True
+
+    def __init__(self, dataobj, indices):
+        self._dataobj = dataobj
+        self.indices = np.asarray(indices, dtype=np.intp)
+        self.dtype = np.dtype(dataobj.dtype)
+        if hasattr(dataobj, 'slope') and hasattr(dataobj, 'inter'):
+            # nibabel array proxy: its dtype is the stored one, the values
+            # read are scaled
+            from nibabel.volumeutils import apply_read_scaling
+            self.dtype = apply_read_scaling(
+                np.zeros(1, dtype=self.dtype), dataobj.slope,
+                dataobj.inter).dtype
+
+    @property
+    def shape(self):
+        return tuple(self._dataobj.shape[:3]) + (len(self.indices), )
+
+    @property
+    def ndim(self):
+        return 4
+
+    def _read_volumes(self, indices):
+        # Runs of consecutive volumes are read at once
+        if len(indices) == 0:
+            return np.empty(self._dataobj.shape[:3] + (0, ),
+                            dtype=self.dtype)
+        breaks = np.where(np.diff(indices) != 1)[0] + 1
+        runs = zip(np.concatenate(([0], breaks)),
+                   np.concatenate((breaks, [len(indices)])))
+        data = [np.asarray(self._dataobj[..., int(indices[start]):
+                                         int(indices[stop - 1]) + 1])
+                for start, stop in runs]
+        if len(data) == 1:
+            return data[0]
+        return np.concatenate(data, axis=-1)
+
+    def __getitem__(self, slicer):
+        if not isinstance(slicer, tuple):
+            slicer = (slicer, )
+        if Ellipsis in slicer:
+            position = slicer.index(Ellipsis)
+            slicer = (slicer[:position]
+                      + (slice(None), ) * (5 - len(slicer))
+                      + slicer[position + 1:])
+        slicer = slicer + (slice(None), ) * (4 - len(slicer))
+        indices = self.indices[slicer[3]]
+        if np.ndim(indices) == 0:
+            return self._read_volumes([indices])[slicer[:3] + (0, )]
+        return self._read_volumes(indices)[slicer[:3] + (Ellipsis, )]
+
+    def __array__(self, dtype=None):
+        data = self._read_volumes(self.indices)
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    def __deepcopy__(self, memo):
+        # The proxy is never modified in place: no need to duplicate the
+        # (potentially large) underlying array
+        return self
+
+
+def _unscaled_data(niimg):
+    """ Return the stored data of a niimg, without applying scaling
+
+    Parameters
+    ----------
+    niimg: nifti-like object
+
+    Returns
+    -------
+    data: numpy.ndarray
+        The data as stored (on disk or in memory).
+
+    slopes, inters: numpy.ndarray or None
+        Scaling to apply to data along its last dimension (one value per
+        volume) to obtain the values returned by niimg.get_data(), with
+        the type of these values. None if no scaling is needed: in this
+        case, data is equal to niimg.get_data().
+
+    Notes
+    -----
+    As _safe_get_data, this function has no side effect on niimg.
+    """
+    if getattr(niimg, '_data_cache', None) is None:
+        dataobj = getattr(niimg, 'dataobj', getattr(niimg, '_data', None))
+        if isinstance(dataobj, _ScaledArrayProxy):
+            return dataobj.get_unscaled(), dataobj.slopes, dataobj.inters
+        if hasattr(dataobj, 'get_unscaled') and hasattr(dataobj, 'slope'):
+            data = dataobj.get_unscaled()
+            if dataobj.slope == 1 and dataobj.inter == 0:
+                return data, None, None
+            n_volumes = data.shape[-1] if data.ndim > 3 else 1
+            return (data, np.repeat(dataobj.slope, n_volumes),
+                    np.repeat(dataobj.inter, n_volumes))
+    return _safe_get_data(niimg), None, None
+
+
+def _get_dataobj(niimg):
+    """ Return an array-like object giving access to the data of a niimg
+
+    If the data of niimg is not loaded, this is its array proxy: slicing
+    it reads only the corresponding part of the data (for instance a few
+    volumes of a 4D image). Otherwise, the data array is returned.
+
+    As _safe_get_data, this function has no side effect on niimg.
+    """
+    if getattr(niimg, '_data_cache', None) is None:
+        dataobj = getattr(niimg, 'dataobj', getattr(niimg, '_data', None))
+        if hasattr(dataobj, '__getitem__') and hasattr(dataobj, 'shape'):
+            return dataobj
+    return _safe_get_data(niimg)
+
+
+def _is_compressed(niimg):
+    """ Whether the data of a niimg is to be read from a compressed file
+
+    Such a file can only be read sequentially: reading a volume requires
+    decompressing the file from its start.
+    """
+    file_like = getattr(_get_dataobj(niimg), 'file_like', None)
+    if not isinstance(file_like, basestring):
+        return False
+    from nibabel.openers import ImageOpener
+    with ImageOpener(file_like) as fileobj:
+        # Only plain files can be memory-mapped
+        return not isinstance(fileobj.fobj, file)
+
+
+def _iter_volumes(niimg, chunks):
+    """ Iterate over chunks of volumes of a niimg
+
+    Parameters
+    ----------
+    niimg: nifti-like object
+        3D or 4D image. A 3D image is considered as a single volume.
+
+    chunks: list of (start, stop) tuples
+        Bounds of the chunks of volumes, in increasing order.
+
+    Yields
+    ------
+    data: numpy.ndarray
+        4D array of the volumes start:stop, for each chunk. When the data
+        of niimg is not loaded, only these volumes are read from the file.
+        Arrays read from files are writable. Otherwise they are views on
+        the data of niimg: they must not be modified in place.
+
+    Notes
+    -----
+    Uncompressed files are memory-mapped. Compressed files cannot be read
+    at random positions without decompressing them from the start: they
+    are read as a single stream (one per call), hence the ordered chunks.
+    """
+    dataobj = _get_dataobj(niimg)
+    shape = dataobj.shape
+    if len(shape) == 3:
+        for _ in chunks:
+            yield np.asarray(dataobj)[..., np.newaxis]
+        return
+    file_like = getattr(dataobj, 'file_like', None)
+    if (len(shape) != 4 or not isinstance(file_like, basestring)
+            or getattr(dataobj, 'order', 'F') != 'F'
+            or not hasattr(dataobj, 'offset')):
+        # In-memory data, or proxy of an unknown kind
+        for start, stop in chunks:
+            yield np.asarray(dataobj[..., start:stop])
+        return
+    from nibabel.openers import ImageOpener
+    from nibabel.volumeutils import apply_read_scaling
+    if not _is_compressed(niimg):
+        data = dataobj.get_unscaled()
+        for start, stop in chunks:
+            yield apply_read_scaling(data[..., start:stop],
+                                     dataobj.slope, dataobj.inter)
+        return
+    volume_shape = shape[:3]
+    volume_bytes = np.prod(volume_shape) * dataobj.dtype.itemsize
+    with ImageOpener(file_like) as fileobj:
+        for start, stop in chunks:
+            fileobj.seek(dataobj.offset + start * volume_bytes)
+            # A bytearray gives a writable array, as when reading the
+            # whole file
+            data = np.frombuffer(
+                bytearray(fileobj.read((stop - start) * volume_bytes)),
+                dtype=dataobj.dtype)
+            data = data.reshape(volume_shape + (stop - start, ), order='F')
+            yield apply_read_scaling(data, dataobj.slope, dataobj.inter)
+
+
 def concat_niimgs(niimgs, dtype=np.float32):
     """Concatenate a list of niimgs
 
@@ -160,6 +426,14 @@ def concat_niimgs(niimgs, dtype=np.float32):
     niimgs: iterable of niimgs
         niimgs to concatenate.
 
+    dtype: numpy dtype or None, optional
+        dtype of the concatenated data. If None, the data is kept in the
+        dtype used for storage when it is an integer type, and the
+        scaling of each image (scl_slope and scl_inter) is applied lazily,
+        when the data is accessed. get_data() on the output then returns
+        float32 values, but the memory used by the concatenated image is
+        that of the stored data (half of float32 for int16 data).
+
     Returns
     -------
     concatenated: nibabel.Nifti1Image
@@ -168,13 +442,29 @@ def concat_niimgs(niimgs, dtype=np.float32):
 
     first_niimg = check_niimg(iter(niimgs).next())
     affine = first_niimg.get_affine()
-    first_data = first_niimg.get_data()
+    if dtype is None:
+        first_data, slope, inter = _unscaled_data(first_niimg)
+        if first_data.dtype.kind not in ('i', 'u'):
+            # Lazy scaling is only useful for integer types
+            dtype = np.float32
+            first_data = first_niimg.get_data()
+            slope = None
+    else:
+        first_data = first_niimg.get_data()
+        slope = None
+    lazy_scaling = dtype is None
     first_data_shape = first_data.shape
     # Using fortran order makes concatenation much faster than with C order,
     # because the voxels for a given image are grouped together in memory.
     data = np.ndarray(first_data_shape + (len(niimgs),),
-                      order="F", dtype=dtype)
+                      order="F",
+                      dtype=first_data.dtype if lazy_scaling else dtype)
     data[..., 0] = first_data
+    if lazy_scaling:
+        slopes = np.ones(len(niimgs), dtype=np.float32)
+        inters = np.zeros(len(niimgs), dtype=np.float32)
+        if slope is not None:
+            slopes[0], inters[0] = slope[0], inter[0]
     del first_data, first_niimg
 
     for index, iter_niimg in enumerate(niimgs):
@@ -193,7 +483,17 @@ def concat_niimgs(niimgs, dtype=np.float32):
                              "Wrong affine:\n%s"
                              % (i_error,
                              repr(affine), repr(niimg.get_affine())))
-        this_data = niimg.get_data()
+        if lazy_scaling:
+            this_data, slope, inter = _unscaled_data(niimg)
+            if not np.can_cast(this_data.dtype, data.dtype):
+                # Incompatible storage types: give up lazy scaling
+                data = np.asarray(_ScaledArrayProxy(data, slopes, inters))
+                lazy_scaling = False
+                this_data = niimg.get_data()
+            elif slope is not None:
+                slopes[index], inters[index] = slope[0], inter[0]
+        else:
+            this_data = niimg.get_data()
         if this_data.shape != first_data_shape:
             if (isinstance(iter_niimg, basestring)):
                 i_error = "image " + iter_niimg
@@ -202,6 +502,8 @@ def concat_niimgs(niimgs, dtype=np.float32):
             raise ValueError("Shape of %s is different from first image shape."
                              % i_error)
         data[..., index] = this_data
+    if lazy_scaling:
+        data = _ScaledArrayProxy(data, slopes, inters)
     return nibabel.Nifti1Image(data, affine)
 
 
@@ -276,5 +578,7 @@ def check_niimgs(niimgs, accept_3d=False):
     if dim == 4:
         niimg = check_niimg(niimgs)
     else:
-        niimg = concat_niimgs(niimgs)
+        # Keep integer data in its stored type: scaling is applied when
+        # the data is accessed
+        niimg = concat_niimgs(niimgs, dtype=None)
     return niimg
@@ -68,7 +68,8 @@ def session_pca(niimgs, mask_img, parameters,
     data, affine = cache(
         filter_and_mask, memory=memory, ref_memory_level=ref_memory_level,
         memory_level=2,
-        ignore=['verbose', 'memory', 'ref_memory_level', 'copy'])(
+        ignore=['verbose', 'memory', 'ref_memory_level', 'copy',
+                'n_jobs'])(
             niimgs, mask_img, parameters,
             ref_memory_level=ref_memory_level,
             memory=memory,
@@ -2,10 +2,13 @@
 Mathematical operations working on niimgs like -a (3+n)-D block of data,
 and an affine.
 """
-from .resampling import resample_img
+from .resampling import resample_img, clear_resampling_cache
 from .image import high_variance_confounds, smooth_img, crop_img, \
-            mean_img
+            mean_img, running_stats, math_img, index_img, iter_img, \
+            threshold_img
 
 __all__ = ['resample_img', 'high_variance_confounds', 'smooth_img',
-           'crop_img', 'mean_img', 'reorder_img']
+           'crop_img', 'mean_img', 'reorder_img', 'running_stats',
+           'math_img', 'index_img', 'iter_img', 'threshold_img',
+           'clear_resampling_cache']
 
@@ -4,13 +4,18 @@ Utilities to resample a Nifti Image
 # Author: Gael Varoquaux, Alexandre Abraham, Michael Eickenberg
 # License: simplified BSD
 
+import hashlib
 import warnings
+import weakref
+from collections import OrderedDict
 
 import numpy as np
-from scipy import ndimage, linalg
+from scipy import ndimage, linalg, sparse
 from nibabel import Nifti1Image
+from sklearn.externals.joblib import Parallel, delayed, cpu_count
 
 from .. import _utils
+from .._utils.niimg_conversions import _get_dataobj
 
 ###############################################################################
 # Affine utils
@@ -212,9 +217,9 @@ class BoundingBoxError(ValueError):
 # Resampling
 
 def _resample_one_img(data, A, A_inv, b, target_shape,
-                      interpolation_order, out, copy=True):
+                      interpolation_order, out, copy=True, prefiltered=False):
     "Internal function for resample_img, do not use"
-    if data.dtype.kind in ('i', 'u'):
+    if prefiltered or data.dtype.kind in ('i', 'u'):
         # Integers are always finite
         has_not_finite = False
     else:
@@ -240,7 +245,8 @@ def _resample_one_img(data, A, A_inv, b, target_shape,
                              offset=np.dot(A_inv, b),
                              output_shape=target_shape,
                              output=out,
-                             order=interpolation_order)
+                             order=interpolation_order,
+                             prefilter=not prefiltered)
     if has_not_finite:
         # We need to resample the mask of not_finite values
         not_finite = ndimage.affine_transform(not_finite, A,
@@ -251,8 +257,509 @@ def _resample_one_img(data, A, A_inv, b, target_shape,
     return out
 
 
+def _interpolation_weights(coords, size, interpolation_order):
+    """ Indices and weights of the input voxels used by
+        ndimage.affine_transform to interpolate at the given coordinates,
+        along an axis of the given size.
+
+        Coordinates outside of the input grid get null weights (the
+        output is 0, as with the 'constant' mode of ndimage).
+
+        Returns
+        -------
+        indices, weights: ndarrays of shape (len(coords), order + 1)
+    """
+    inside = (coords >= 0) & (coords <= size - 1)
+    if interpolation_order == 0:
+        indices = np.floor(coords + .5)[:, np.newaxis]
+        weights = np.ones((len(coords), 1))
+    elif interpolation_order == 3:
+        start = np.floor(coords)
+        t = coords - start
+        indices = start[:, np.newaxis] + np.arange(-1, 3)
+        t2 = t * t
+        t3 = t2 * t
+        weights = np.column_stack(((1 - t) ** 3,
+                                   4 - 6 * t2 + 3 * t3,
+                                   1 + 3 * t + 3 * t2 - 3 * t3,
+                                   t3)) / 6.
+    else:
+        raise ValueError("Unsupported interpolation order: %i"
+                         % interpolation_order)
+    indices[np.logical_not(inside)] = 0
+    weights[np.logical_not(inside)] = 0
+    indices = indices.astype(np.intp)
+    # ndimage mirrors the grid at the edges (without repeating the edge)
+    if size == 1:
+        indices[:] = 0
+    else:
+        period = 2 * (size - 1)
+        indices %= period
+        indices = np.where(indices > size - 1, period - indices, indices)
+    return indices, weights
+
+
+def _nearest_indices(coords, size):
+    """ Indices of the input voxels used by ndimage.affine_transform with
+        nearest neighbor interpolation (order 0) at the given coordinates,
+        along an axis of the given size, and mask of the coordinates
+        outside of the input grid (None if all are inside).
+    """
+    outside = (coords < 0)
+    outside |= (coords > size - 1)
+    indices = coords + .5
+    np.floor(indices, out=indices)
+    indices = indices.astype(np.intp)
+    if not np.any(outside):
+        return indices, None
+    indices[outside] = 0
+    return indices, outside
+
+
+def _weights_matrix(indices, weights, input_size):
+    """ Sparse matrix of the interpolation weights, with one row per
+        output point.
+    """
+    n_outputs, n_weights = indices.shape
+    return sparse.csr_matrix(
+        (weights.ravel(), indices.ravel(),
+         np.arange(0, n_outputs * n_weights + 1, n_weights)),
+        shape=(n_outputs, input_size))
+
+
+def _spline_filter(data, interpolation_order):
+    """ Spline coefficients of the data (float64), computed as in the
+        prefiltering of ndimage, restricted to the 3 spatial axes.
+    """
+    for axis in range(3):
+        data = ndimage.spline_filter1d(data, interpolation_order, axis=axis,
+                                       output=np.float64)
+    return data
+
+
+# Spline coefficients of the data resampled recently with
+# cache_coefficients=True, by id of the data array. Each entry holds a weak
+# reference to the array, and is removed when the array is deleted.
+_spline_coefficients = OrderedDict()
+
+# Total size, in bytes, of the spline coefficients kept in memory
+_MAX_CACHED_COEFFICIENTS_BYTES = 2e8
+
+
+def _get_spline_coefficients(data, interpolation_order):
+    """ Return the spline coefficients of the data, reusing the ones
+        computed recently for the same array.
+    """
+    key = id(data)
+    ref, order, coefficients = _spline_coefficients.pop(key,
+                                                        (None, None, None))
+    if ref is None or ref() is not data or order != interpolation_order:
+        coefficients = _spline_filter(data, interpolation_order)
+        if coefficients.nbytes > _MAX_CACHED_COEFFICIENTS_BYTES:
+            return coefficients
+        ref = weakref.ref(data,
+                          lambda _: _spline_coefficients.pop(key, None))
+    _spline_coefficients[key] = (ref, interpolation_order, coefficients)
+    while (sum(c.nbytes for _, _, c in _spline_coefficients.values())
+            > _MAX_CACHED_COEFFICIENTS_BYTES):
+        _spline_coefficients.popitem(last=False)
+    return coefficients
+
+
+def _target_coordinates(matrix, offset, grid):
+    """ Coordinates, in the input grid, of the given output voxels (an
+        array of shape (3, n_voxels)), computed as in
+        ndimage.affine_transform with the same matrix and offset.
+    """
+    coords = np.empty(grid.shape)
+    if matrix.ndim == 1:
+        # As in ndimage.zoom_shift
+        shift = offset / matrix
+        for axis in range(3):
+            coords[axis] = (grid[axis] + shift[axis]) * matrix[axis]
+    else:
+        for axis in range(3):
+            coords[axis] = (matrix[axis, 0] * grid[0]
+                            + matrix[axis, 1] * grid[1]
+                            + matrix[axis, 2] * grid[2] + offset[axis])
+    return coords
+
+
+def _grid_coordinates(matrix, offset, output_shape):
+    """ Coordinates, in the input grid, of all the voxels of the output
+        grid, as an array of shape (3, ) + output_shape. Same as
+        _target_coordinates for a (non-diagonal) matrix, but computed by
+        broadcasting along the output axes.
+    """
+    i, j, k = [np.arange(size, dtype=np.float64) for size in output_shape]
+    coords = np.empty((3, ) + tuple(output_shape))
+    for axis in range(3):
+        coords[axis] = ((matrix[axis, 0] * i)[:, np.newaxis, np.newaxis]
+                        + (matrix[axis, 1] * j)[:, np.newaxis])
+        coords[axis] += matrix[axis, 2] * k
+        coords[axis] += offset[axis]
+    return coords
+
+
+class _ResamplingPlan(object):
+    """ Interpolation weights of an affine resampling, computed once to
+        be applied to all the volumes of an image.
+
+        The plan gives, for each output voxel, the input voxels and the
+        weights used by ndimage.affine_transform (with the same matrix and
+        offset): applying it to an image gives the same result as calling
+        affine_transform on each volume.
+
+        If the matrix is diagonal (given as a 1D array), the resampling is
+        separable and the plan holds one sparse matrix per axis. Otherwise,
+        it holds a single sparse matrix, mapping the flattened (in Fortran
+        order, as nibabel arrays) input volumes to the flattened output
+        volumes.
+
+        If an output mask is given, only the output voxels in the mask
+        are computed, and the plan always holds a single sparse matrix:
+        the resampled data has one row per voxel of the mask (ordered as
+        in data[mask]) instead of the 3 output dimensions.
+
+        For nearest neighbor interpolation (order 0), the plan holds the
+        indices of the nearest input voxels instead of weights: the data
+        is gathered, which keeps its dtype and values exactly. If the
+        resampling is not separable, these are indices in the flattened
+        (in Fortran order) input volumes, stored as int32 when possible.
+    """
+
+    def __init__(self, matrix, offset, input_shape, output_shape,
+                 interpolation_order, output_mask=None):
+        self.input_shape = tuple(input_shape)
+        self.output_shape = tuple(output_shape)
+        self.interpolation_order = interpolation_order
+        self.masked = output_mask is not None
+        matrix = np.asarray(matrix, dtype=np.float64)
+        offset = np.asarray(offset, dtype=np.float64)
+        self.weights = self.axis_weights = None
+        self.indices = self.axis_indices = None
+        if matrix.ndim == 1 and not self.masked:
+            # Coordinates are computed as in ndimage.zoom_shift
+            shift = offset / matrix
+            self.axis_weights = []
+            self.axis_indices = []
+            for zoom, this_shift, input_size, output_size in zip(
+                    matrix, shift, input_shape, output_shape):
+                coords = (np.arange(output_size) + this_shift) * zoom
+                if interpolation_order == 0:
+                    self.axis_indices.append(
+                        _nearest_indices(coords, input_size))
+                else:
+                    self.axis_weights.append(_weights_matrix(
+                        *_interpolation_weights(coords, input_size,
+                                                interpolation_order),
+                        input_size=input_size))
+            if interpolation_order == 0:
+                self.axis_weights = None
+            else:
+                self.axis_indices = None
+        elif interpolation_order == 0:
+            if self.masked:
+                coords = _target_coordinates(
+                    matrix, offset, np.array(np.where(output_mask)))
+            else:
+                coords = _grid_coordinates(matrix, offset, output_shape)
+                coords = coords.reshape((3, -1))
+            indices, outside = zip(*[
+                _nearest_indices(coords[axis], input_shape[axis])
+                for axis in range(3)])
+            del coords
+            outside = [o for o in outside if o is not None]
+            # A single flat index takes 6 times less memory than 3 intp
+            # indices
+            input_size = int(np.prod(input_shape[:3]))
+            indices = np.ravel_multi_index(indices, input_shape[:3],
+                                           order='F')
+            if input_size <= np.iinfo(np.int32).max:
+                indices = indices.astype(np.int32)
+            self.indices = (indices,
+                            np.logical_or.reduce(outside) if outside
+                            else None)
+        else:
+            if self.masked:
+                coords = _target_coordinates(
+                    matrix, offset, np.array(np.where(output_mask)))
+            else:
+                coords = _grid_coordinates(matrix, offset, output_shape)
+                coords = coords.reshape((3, -1), order='F')
+            n_outputs = coords.shape[1]
+            indices = np.zeros((n_outputs, 1), dtype=np.intp)
+            weights = np.ones((n_outputs, 1))
+            for axis in range(3):
+                axis_indices, axis_weights = _interpolation_weights(
+                    coords[axis], input_shape[axis], interpolation_order)
+                # Combine with the interpolation points of the previous
+                # axes, to get the indices in the flattened input
+                stride = int(np.prod(input_shape[:axis]))
+                indices = (indices[:, :, np.newaxis]
+                           + stride * axis_indices[:, np.newaxis, :])
+                indices = indices.reshape((n_outputs, -1))
+                weights = (weights[:, :, np.newaxis]
+                           * axis_weights[:, np.newaxis, :])
+                weights = weights.reshape((n_outputs, -1))
+            self.weights = _weights_matrix(
+                indices, weights, input_size=int(np.prod(input_shape[:3])))
+
+    @property
+    def nbytes(self):
+        if self.indices is not None:
+            arrays = list(self.indices)
+        elif self.axis_indices is not None:
+            arrays = [a for indices in self.axis_indices for a in indices]
+        else:
+            matrices = ([self.weights] if self.weights is not None
+                        else self.axis_weights)
+            arrays = [a for m in matrices
+                      for a in (m.data, m.indices, m.indptr)]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    @property
+    def resampled_shape(self):
+        "Shape of the resampled data, without the extra dimensions"
+        if self.masked and self.indices is not None:
+            return (len(self.indices[0]), )
+        elif self.masked:
+            return (self.weights.shape[0], )
+        return self.output_shape
+
+    def resample(self, data, prefiltered=False):
+        """ Resample the data, whose first 3 dimensions must match the
+            input shape of the plan. The extra dimensions (eg time) are
+            kept.
+
+            If prefiltered is True, data holds the spline coefficients
+            of the image (see _spline_filter).
+        """
+        extra_shape = data.shape[3:]
+        if self.indices is not None:
+            indices, outside = self.indices
+            # No copy for the Fortran-ordered arrays of nibabel
+            data = data.reshape((-1, ) + extra_shape, order='F')
+            resampled = data.take(indices, axis=0)
+            if outside is not None:
+                resampled[outside] = 0
+            return resampled.reshape(self.resampled_shape + extra_shape)
+        if self.axis_indices is not None:
+            for axis, (indices, outside) in enumerate(self.axis_indices):
+                data = data.take(indices, axis=axis)
+                if outside is not None:
+                    data[(slice(None), ) * axis + (outside, )] = 0
+            return data
+        if self.interpolation_order > 1 and not prefiltered:
+            data = _spline_filter(data, self.interpolation_order)
+        if self.weights is not None:
+            resampled = self.weights.dot(
+                data.reshape((self.weights.shape[1], -1), order='F'))
+            return resampled.reshape(self.resampled_shape + extra_shape,
+                                     order='F')
+        for axis, weights in enumerate(self.axis_weights):
+            data = np.rollaxis(data, axis)
+            shape = data.shape
+            data = weights.dot(data.reshape((shape[0], -1)))
+            data = np.rollaxis(data.reshape((-1, ) + shape[1:]), 0, axis + 1)
+        return data
+
+
+# Plans used recently, by _get_resampling_plan
+_resampling_plans = OrderedDict()
+
+# Total size, in bytes, of the plans kept in memory
+_MAX_CACHED_PLANS_BYTES = 1e8
+
+# Size, in bytes, of the largest plan kept in memory. Larger plans (eg a
+# rotation onto a 1mm grid) are used for the current call only.
+_MAX_CACHED_PLAN_BYTES = 2e7
+
+# Maximum number of volumes resampled at once with a plan
+_PLAN_CHUNK_VOLUMES = 16
+
+# Maximum number of interpolation weights of a non-separable plan. Larger
+# resamplings are done volume per volume, as their plan would use too
+# much memory.
+_MAX_PLAN_WEIGHTS = 1e7
+
+
+def _plan_nbytes(n_outputs, interpolation_order):
+    """ Size, in bytes, of a non-separable plan: an int32 index and a
+        float64 weight per interpolation point (nearest plans have a single
+        point and no weights, but a mask of the outside voxels).
+    """
+    if interpolation_order == 0:
+        return n_outputs * 5
+    return n_outputs * (interpolation_order + 1) ** 3 * 12
+
+
+def _get_resampling_plan(matrix, offset, input_shape, output_shape,
+                         interpolation_order, output_mask=None,
+                         allow_uncached=True):
+    """ Return the resampling plan for the given transform, shapes and
+        interpolation order (and output mask, if any), reusing the plans
+        computed recently.
+
+        Returns None if the plan would be too large, or, if allow_uncached
+        is False, too large to be kept for later calls (computing such a
+        plan for a single volume is slower than resampling it directly).
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    offset = np.asarray(offset, dtype=np.float64)
+    if output_mask is not None:
+        output_mask = np.asarray(output_mask, dtype=np.bool)
+        n_outputs = output_mask.sum()
+        mask_key = hashlib.md5(np.packbits(output_mask)).hexdigest()
+    else:
+        n_outputs = np.prod(output_shape)
+        mask_key = None
+    if ((matrix.ndim == 2 or output_mask is not None)
+            and n_outputs * (interpolation_order + 1) ** 3
+            > _MAX_PLAN_WEIGHTS):
+        return None
+    if ((matrix.ndim == 2 or output_mask is not None)
+            and _plan_nbytes(n_outputs, interpolation_order)
+            > _MAX_CACHED_PLAN_BYTES):
+        if not allow_uncached:
+            return None
+        return _ResamplingPlan(matrix, offset, input_shape[:3],
+                               output_shape, interpolation_order,
+                               output_mask=output_mask)
+    key = (matrix.tostring(), matrix.shape, offset.tostring(),
+           tuple(input_shape[:3]), tuple(output_shape), interpolation_order,
+           mask_key)
+    plan = _resampling_plans.pop(key, None)
+    if plan is None:
+        plan = _ResamplingPlan(matrix, offset, input_shape[:3],
+                               output_shape, interpolation_order,
+                               output_mask=output_mask)
+    _resampling_plans[key] = plan
+    while (len(_resampling_plans) > 1
+            and sum(p.nbytes for p in _resampling_plans.values())
+            > _MAX_CACHED_PLANS_BYTES):
+        _resampling_plans.popitem(last=False)
+    return plan
+
+
+def clear_resampling_cache():
+    """Free the memory used by resample_img to speed up later calls
+
+    This removes the resampling plans and the spline coefficients kept in
+    memory (see the notes of resample_img). They are otherwise kept for
+    the lifetime of the process, up to a few hundred megabytes.
+    """
+    _resampling_plans.clear()
+    _spline_coefficients.clear()
+
+
+def _integer_grid_transform(transform_affine, tolerance=1e-6):
+    """ Check whether a transform maps the voxels of the target grid onto
+        voxels of the source grid: its matrix must be a permutation
+        matrix, with integer non-null entries (the steps, negative for
+        flips), and its offset must be integer.
+
+        Returns
+        -------
+        None if the transform does not map the grids, else:
+
+        axes: list of 3 integers
+            For each target axis, the corresponding source axis.
+        steps, offsets: lists of 3 integers
+            For each target axis, the source voxel index corresponding to
+            the target index i is offsets[axis] + steps[axis] * i.
+    """
+    A, b = to_matrix_vector(transform_affine)
+    A_int = np.round(A)
+    b_int = np.round(b)
+    if (np.abs(A - A_int).max() > tolerance
+            or np.abs(b - b_int).max() > tolerance):
+        return None
+    non_null = (A_int != 0)
+    if not (np.all(non_null.sum(axis=0) == 1)
+            and np.all(non_null.sum(axis=1) == 1)):
+        return None
+    axes = [int(axis) for axis in np.argmax(non_null, axis=0)]
+    steps = [int(A_int[axis, i]) for i, axis in enumerate(axes)]
+    offsets = [int(b_int[axis]) for axis in axes]
+    return axes, steps, offsets
+
+
+def _resample_integer_grid(data, axes, steps, offsets, target_shape,
+                           copy=True, order="F"):
+    """ Resample data on a target grid made of voxels of the source grid
+        (see _integer_grid_transform), by slicing.
+
+        If copy is False and all the target voxels are in the source
+        grid (eg a crop, a subsampling, a flip or a permutation of
+        axes), a view on the data is returned.
+    """
+    data = np.transpose(data, axes + range(3, data.ndim))
+    source_slices = []
+    target_slices = []
+    for size, target_size, step, offset in zip(data.shape, target_shape,
+                                               steps, offsets):
+        # Target indices i such that 0 <= offset + step * i <= size - 1
+        # (with floor and ceil divisions of integers)
+        if step > 0:
+            start = -((offset) // step)
+            stop = (size - 1 - offset) // step + 1
+        else:
+            start = -((offset - size + 1) // step)
+            stop = offset // -step + 1
+        start = max(start, 0)
+        stop = min(stop, target_size)
+        if stop <= start:
+            # No target voxel in the source grid
+            return np.zeros(tuple(target_shape) + data.shape[3:],
+                            dtype=data.dtype, order=order)
+        source_start = offset + step * start
+        source_stop = offset + step * (stop - 1) + (1 if step > 0 else -1)
+        source_slices.append(slice(source_start,
+                                   source_stop if source_stop >= 0
+                                   else None, step))
+        target_slices.append(slice(start, stop))
+    resampled = data[tuple(source_slices)]
+    if resampled.shape[:3] == tuple(target_shape):
+        if copy:
+            resampled = np.array(resampled, order=order)
+        return resampled
+    out = np.zeros(tuple(target_shape) + data.shape[3:], dtype=data.dtype,
+                   order=order)
+    out[tuple(target_slices)] = resampled
+    return out
+
+
+def _get_resampled_dtype(dtype, interpolation_order):
+    """ dtype of the resampling of 4D (or masked) data of the given dtype:
+        the dtype of the data is kept, except for integers with continuous
+        interpolation, resampled as float32 (as are half floats, that
+        ndimage does not support).
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.dtype(np.float32) if dtype.itemsize < 4 else dtype
+    if interpolation_order == 0 and dtype.kind in ('i', 'u', 'b'):
+        return dtype
+    return np.dtype(np.float32)
+
+
+def _resample_with_plan(plan, data, out, prefiltered=False):
+    "Internal function for resample_img, do not use"
+    out[...] = plan.resample(data, prefiltered=prefiltered)
+
+
+def _resample_one_img_masked(data, coords, interpolation_order, out,
+                             prefiltered=False):
+    "Internal function for resample_img, do not use"
+    ndimage.map_coordinates(data, coords, output=out,
+                            order=interpolation_order,
+                            prefilter=not prefiltered)
+
+
 def resample_img(niimg, target_affine=None, target_shape=None,
-                 interpolation='continuous', copy=True, order="F"):
+                 interpolation='continuous', copy=True, order="F",
+                 n_jobs=1, target_mask=None, cache_coefficients=False):
     """Resample a Nifti image
 
     Parameters
@@ -282,11 +789,30 @@ def resample_img(niimg, target_affine=None, target_shape=None,
         Data ordering in output array. This function is slightly faster with
         Fortran ordering.
 
+    n_jobs: integer, optional
+        The number of threads used to resample the volumes of 4D images.
+        -1 means 'all cpus'.
+
+    target_mask: 3D boolean numpy.ndarray, optional
+        If specified, only the voxels of the target grid in this mask are
+        computed, and the masked data is returned instead of an image (as
+        with nilearn.masking.apply_mask). A 4x4 target_affine must then be
+        given; target_shape defaults to the shape of the mask.
+
+    cache_coefficients: bool, optional
+        If True, the spline coefficients of the data (computed for
+        continuous interpolation) are kept in memory, and reused when the
+        same image is resampled again, eg to other target grids. The data
+        of the image must then not be modified in place between the calls.
+
     Returns
     =======
     resampled: nibabel.Nifti1Image
         input image, resampled to have respectively target_shape and
         target_affine as shape and affine.
+        If target_mask is given, a numpy.ndarray of shape (n_voxels, ) for
+        a 3D image, or (n_volumes, n_voxels) for a 4D image, holding the
+        resampled values of the voxels of the mask.
 
     Notes
     =====
@@ -320,6 +846,43 @@ def resample_img(niimg, target_affine=None, target_shape=None,
     **NaNs and infinite values**
     This function handles gracefully NaNs and infinite values in the input
     data, however they make the execution of the function much slower.
+
+    **Integer grids**
+    If the voxels of the target grid are voxels of the input grid (crops,
+    pads, flips or permutations of axes, subsampling by integer factors),
+    no interpolation is needed and the data is simply sliced, keeping its
+    data type. With copy=False, the output may then be a view on the input
+    data.
+
+    **Data types**
+    The resampling of 3D images has the data type of the input data. For
+    4D images, or with a target_mask, floats keep their data type, as do
+    integers with nearest interpolation; integers are resampled as
+    float32 with continuous interpolation. Nearest interpolation copies
+    the values of the nearest input voxels, without any conversion (eg
+    for label images).
+
+    **Spline coefficients**
+    Continuous interpolation first computes the spline coefficients of the
+    whole input image, which often takes longer than the interpolation
+    itself. With cache_coefficients=True, an image (eg an atlas or a
+    template) resampled to many target grids pays this cost only once. The
+    coefficients are kept until the data array of the image is deleted.
+
+    **Target mask**
+    Resampling only the voxels of a mask is much faster than resampling
+    the whole target grid and masking the result, when the mask is small
+    compared to its bounding box (eg a brain mask).
+
+    **Memory used between calls**
+    The interpolation weights of 4D images, of target masks, and of
+    nearest interpolation are computed once for all the volumes, and kept
+    in memory for later calls with the same grids. For rotations and
+    shears, they take 5 bytes per target voxel with nearest
+    interpolation, and up to 768 bytes per target voxel with continuous
+    interpolation: larger than 20MB, they are not kept, and at most 100MB
+    of them are kept. With cache_coefficients=True, up to 200MB of spline
+    coefficients are also kept. clear_resampling_cache frees this memory.
     """
     # Do as many checks as possible before loading data, to avoid potentially
     # costly calls before raising an exception.
@@ -332,6 +895,18 @@ def resample_img(niimg, target_affine=None, target_shape=None,
                          'the 3D grid, and thus of length 3. %s was specified'
                          % str(target_shape))
 
+    if target_mask is not None:
+        target_mask = np.asarray(target_mask, dtype=np.bool)
+        if target_affine is None or np.shape(target_affine) != (4, 4):
+            raise ValueError("If target_mask is specified, a 4x4 "
+                             "target_affine should be specified too.")
+        if target_shape is None:
+            target_shape = target_mask.shape
+        elif tuple(target_shape) != target_mask.shape:
+            raise ValueError("target_mask has shape %s while target_shape "
+                             "is %s" % (str(target_mask.shape),
+                                        str(tuple(target_shape))))
+
     if target_shape is not None and target_affine.shape == (3, 3):
         raise ValueError("Given target shape without anchor vector: "
                          "Affine shape should be (4, 4) and not (3, 3)")
@@ -365,6 +940,8 @@ def resample_img(niimg, target_affine=None, target_shape=None,
 
     if (np.all(np.array(target_shape) == shape[:3]) and
             np.allclose(target_affine, affine)):
+        if target_mask is not None:
+            return np.asarray(_get_dataobj(niimg))[target_mask].T
         if copy and not input_niimg_is_string:
             niimg = _utils.copy_niimg(niimg)
         return niimg
@@ -372,7 +949,9 @@ def resample_img(niimg, target_affine=None, target_shape=None,
     # We now know that some resampling must be done.
     # The value of "copy" is of no importance: output is always a separate
     # array.
-    data = niimg.get_data()
+    # The data is not cached in niimg: for images concatenated with lazy
+    # scaling, the scaled data would be kept next to the stored one.
+    data = np.asarray(_get_dataobj(niimg))
 
     # Get a bounding box for the transformed data
     # Embed target_affine in 4x4 shape if necessary
@@ -418,6 +997,20 @@ def resample_img(niimg, target_affine=None, target_shape=None,
         transform_affine = np.eye(4)
     else:
         transform_affine = np.dot(linalg.inv(affine), target_affine)
+
+    grid_transform = _integer_grid_transform(transform_affine)
+    if grid_transform is not None and (data.dtype.kind in ('i', 'u')
+                                       or np.all(np.isfinite(data))):
+        # The target voxels are voxels of the source grid: interpolation
+        # boils down to slicing
+        resampled_data = _resample_integer_grid(
+            data, target_shape=target_shape,
+            copy=copy and not input_niimg_is_string, order=order,
+            *grid_transform)
+        if target_mask is not None:
+            return resampled_data[target_mask].T
+        return Nifti1Image(resampled_data, target_affine)
+
     A, b = to_matrix_vector(transform_affine)
     A_inv = linalg.inv(A)
     # If A is diagonal, ndimage.affine_transform is clever enough to use a
@@ -428,29 +1021,126 @@ def resample_img(niimg, target_affine=None, target_shape=None,
         b = np.dot(A, b)
 
     data_shape = list(data.shape)
+    input_dtype = data.dtype
+    is_finite = (data.dtype.kind in ('i', 'u', 'b')
+                 or np.all(np.isfinite(data)))
+    not_finite = None
+    if not is_finite and len(data_shape) > 3:
+        not_finite = np.logical_not(np.isfinite(data)).reshape(
+            data_shape[:3] + [-1])
+        if np.all(not_finite == not_finite[..., :1]):
+            # The non-finite values are at the same voxels in all the
+            # volumes (eg a NaN background): they are extrapolated, and
+            # their mask resampled, once for all the volumes
+            warnings.warn("NaNs or infinite values are present in the data "
+                          "passed to resample. This is a bad thing as they "
+                          "make resampling ill-defined and much slower.",
+                          RuntimeWarning, stacklevel=2)
+            not_finite = not_finite[..., 0]
+            from ..masking import _extrapolate_out_mask
+            data = _extrapolate_out_mask(data, np.logical_not(not_finite),
+                                         iterations=2)[0]
+            is_finite = True
+        else:
+            # Volumes are resampled one by one, with their own mask
+            not_finite = None
+    plan = None
+    if (len(data_shape) > 3 or target_mask is not None
+            or interpolation_order == 0) and is_finite:
+        # The interpolation weights are the same for all the volumes:
+        # compute them once. With nearest interpolation, the plan gathers
+        # the data directly, which is faster than ndimage even for a
+        # single volume (eg labels or masks).
+        plan = _get_resampling_plan(A, np.dot(A_inv, b), data_shape,
+                                    target_shape, interpolation_order,
+                                    output_mask=target_mask,
+                                    allow_uncached=len(data_shape) > 3)
+    if n_jobs < 0:
+        n_jobs = max(1, cpu_count() + 1 + n_jobs)
+    resampled_dtype = _get_resampled_dtype(input_dtype, interpolation_order)
+    prefiltered = False
+    if (cache_coefficients and interpolation_order > 1 and is_finite
+            and not_finite is None):
+        data = _get_spline_coefficients(data, interpolation_order)
+        prefiltered = True
+    if plan is not None:
+        resampled_data = np.ndarray(list(plan.resampled_shape)
+                                    + data_shape[3:], dtype=resampled_dtype,
+                                    order=order)
+        n_volumes = int(np.prod(data_shape[3:]))
+        flat_data = data.reshape(data_shape[:3] + [n_volumes], order=order)
+        flat_resampled_data = resampled_data.reshape(
+            list(plan.resampled_shape) + [n_volumes], order=order)
+        # The volumes are split in chunks, resampled in threads (the
+        # computations release the GIL) directly in the output array. The
+        # chunks are small enough for the float64 buffers of the
+        # interpolation not to take much memory.
+        n_chunks = max(min(n_jobs, n_volumes),
+                       int(np.ceil(n_volumes / float(_PLAN_CHUNK_VOLUMES))))
+        bounds = np.linspace(0, n_volumes, n_chunks + 1).astype(int)
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(_resample_with_plan)(
+                plan, flat_data[..., start:stop],
+                flat_resampled_data[..., start:stop],
+                prefiltered=prefiltered)
+            for start, stop in zip(bounds[:-1], bounds[1:]))
+    elif target_mask is not None and is_finite:
+        # The mask is too large for a plan: interpolate the volumes at the
+        # coordinates of the voxels of the mask only
+        coords = _target_coordinates(A, np.dot(A_inv, b),
+                                     np.array(np.where(target_mask)))
+        other_shape = data_shape[3:]
+        resampled_data = np.ndarray([coords.shape[1]] + other_shape,
+                                    dtype=resampled_dtype, order=order)
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(_resample_one_img_masked)(
+                data[(Ellipsis, ) + ind], coords, interpolation_order,
+                out=resampled_data[(Ellipsis, ) + ind],
+                prefiltered=prefiltered)
+            for ind in np.ndindex(*other_shape))
     # For images with dimensions larger than 3D:
-    if len(data_shape) > 3:
+    elif len(data_shape) > 3:
         # Iter in a set of 3D volumes, as the interpolation problem is
         # separable in the extra dimensions. This reduces the
         # computational cost
         other_shape = data_shape[3:]
         resampled_data = np.ndarray(list(target_shape) + other_shape,
-                                    order=order)
+                                    dtype=resampled_dtype, order=order)
 
         all_img = (slice(None), ) * 3
 
-        for ind in np.ndindex(*other_shape):
-            _resample_one_img(data[all_img + ind], A, A_inv, b, target_shape,
-                      interpolation_order,
-                      out=resampled_data[all_img + ind],
-                      copy=not input_niimg_is_string)
+        # ndimage releases the GIL: volumes are resampled in threads,
+        # directly in the output array
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(_resample_one_img)(
+                data[all_img + ind], A, A_inv, b, target_shape,
+                interpolation_order,
+                out=resampled_data[all_img + ind],
+                copy=not input_niimg_is_string,
+                prefiltered=prefiltered)
+            for ind in np.ndindex(*other_shape))
     else:
-        resampled_data = np.empty(target_shape, data.dtype)
+        resampled_data = np.empty(target_shape, input_dtype)
         _resample_one_img(data, A, A_inv, b, target_shape,
                           interpolation_order,
                           out=resampled_data,
-                          copy=not input_niimg_is_string)
+                          copy=not input_niimg_is_string,
+                          prefiltered=prefiltered)
 
+    if not_finite is not None:
+        not_finite = ndimage.affine_transform(not_finite, A,
+                                              offset=np.dot(A_inv, b),
+                                              output_shape=target_shape,
+                                              order=0)
+        if target_mask is not None:
+            not_finite = not_finite[target_mask]
+        resampled_data[not_finite] = np.nan
+
+    if target_mask is not None:
+        if not is_finite:
+            # The whole target grid has been resampled
+            resampled_data = resampled_data[target_mask]
+        return resampled_data.T
     return Nifti1Image(resampled_data, target_affine)
 
 
@@ -1,15 +1,21 @@
 """
 Test image pre-processing functions
 """
-from nose.tools import assert_true, assert_false
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_true, assert_false, assert_raises, assert_equal
 
 import nibabel
 import numpy as np
-from numpy.testing import assert_array_equal
+from scipy import ndimage
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 from .. import image
 from .. import resampling
 from ..._utils import testing
+from ..._utils.niimg_conversions import _is_compressed
 
 def test_high_variance_confounds():
     # See also test_signals.test_high_variance_confounds()
@@ -82,6 +88,51 @@ def test__smooth_array():
                                     fwhm / np.abs(affine[axis, axis]))
 
 
+def test__smooth_array_engines():
+    rng = np.random.RandomState(42)
+    data = rng.rand(20, 21, 22, 5)
+    affine = np.diag((2., 3., 1., 1.))
+    # Large enough for the FFT to be used with engine='auto'
+    fwhm = 20.
+    expected = image._smooth_array(data, affine, fwhm=fwhm, engine='direct')
+    for engine in ('auto', 'fft'):
+        assert_array_almost_equal(
+            image._smooth_array(data, affine, fwhm=fwhm, engine=engine),
+            expected)
+    # The recursive filter is an approximation
+    np.testing.assert_allclose(
+        image._smooth_array(data, affine, fwhm=fwhm, engine='iir'),
+        expected, rtol=.02)
+    # Up to kernels much wider than the axis, as the data is reflected at
+    # the edges over the length of the impulse response
+    impulse = np.zeros((40, 2))
+    impulse[0, 0] = 1
+    impulse[20, 1] = 1
+    for sigma in (3., 10., 30., 60.):
+        exact = ndimage.gaussian_filter1d(impulse, sigma, axis=0,
+                                          truncate=50.)
+        filtered = image._iir_gaussian_filter1d(impulse, sigma, 0)
+        assert_true(np.abs(filtered - exact).max() < .04 * exact.max())
+    # float32 data is filtered in single precision
+    filtered = image._smooth_array(data.astype(np.float32), affine,
+                                   fwhm=fwhm, engine='fft')
+    assert_true(filtered.dtype == np.float32)
+    assert_array_almost_equal(filtered, expected, decimal=5)
+
+    # Volumes smoothed in threads
+    for engine in ('direct', 'fft', 'iir'):
+        for this_data in (data, np.asfortranarray(data),
+                          data.reshape((20, 21, 22, 1, 5))):
+            assert_array_equal(
+                image._smooth_array(this_data, affine, fwhm=fwhm,
+                                    engine=engine, n_jobs=2),
+                image._smooth_array(this_data, affine, fwhm=fwhm,
+                                    engine=engine))
+
+    assert_raises(ValueError, image._smooth_array, data, affine, fwhm=fwhm,
+                  engine='invalid')
+
+
 def test_smooth_img():
     # This function only checks added functionalities compared
     # to _smooth_array()
@@ -172,6 +223,32 @@ def test_crop_threshold_tolerance():
     assert_true(cropped_niimg.shape == active_shape)
 
 
+def test_crop_img_bounding_box():
+    affine = np.diag((4, 3, 2, 1))
+    data = np.zeros((7, 8, 9, 3))
+    data[2:4, 1:5, 3:6, 1] = -2
+    data[2, 4, 7, 2] = 1
+    # Float, integer and 4D data
+    for this_data in (data[..., 1], data[..., 1].astype(np.int16),
+                      data[..., 1].astype(np.int8), data):
+        niimg = nibabel.Nifti1Image(this_data, affine)
+        expected_shape = (4, 6, 5) if this_data.ndim == 3 else (4, 6, 7)
+        for cache_bounding_box in (False, True, True):
+            cropped_niimg = image.crop_img(
+                niimg, cache_bounding_box=cache_bounding_box)
+            assert_equal(cropped_niimg.shape[:3], expected_shape)
+
+    # The cached bounding box is reused for the same data array only
+    other_data = np.zeros((7, 8, 9))
+    other_data[1:3, 1:3, 1:3] = 1
+    assert_equal(image.crop_img(nibabel.Nifti1Image(other_data, affine),
+                                cache_bounding_box=True).shape, (4, 4, 4))
+
+    # An image without any non-zero value is not cropped
+    niimg = nibabel.Nifti1Image(np.zeros((5, 6, 7)), affine)
+    assert_equal(image.crop_img(niimg).shape, (5, 6, 7))
+
+
 def test_mean_img():
     rng = np.random.RandomState(42)
     data1 = np.zeros((5, 6, 7))
@@ -207,6 +284,46 @@ def test_mean_img():
             assert_array_equal(mean_img.get_data(), truth)
 
 
+def test_mean_img_chunks():
+    # The volumes are summed by chunks, possibly in parallel
+    rng = np.random.RandomState(42)
+    data = rng.rand(5, 6, 7, 11).astype(np.float32)
+    int_data = rng.randint(100, size=(5, 6, 7, 11)).astype(np.int16)
+    affine = np.diag((4, 3, 2, 1))
+    chunk_bytes = image._STREAM_CHUNK_BYTES
+    image._STREAM_CHUNK_BYTES = 3 * 8 * 5 * 6 * 7
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for this_data in (data, int_data):
+            niimg = nibabel.Nifti1Image(this_data, affine)
+            # Memory-mapped and compressed files, and in-memory data
+            filenames = [os.path.join(tmpdir, 'img.nii'),
+                         os.path.join(tmpdir, 'img.nii.gz')]
+            for filename in filenames:
+                nibabel.save(niimg, filename)
+            # Compressed files are read in a single stream
+            assert_equal([_is_compressed(nibabel.load(filename))
+                          for filename in filenames], [False, True])
+            assert_false(_is_compressed(niimg))
+            for img in filenames + [niimg]:
+                for n_jobs in (1, 2):
+                    mean_img = image.mean_img(img, n_jobs=n_jobs)
+                    assert_equal(mean_img.get_data().dtype,
+                                 this_data.mean(axis=-1).dtype)
+                    assert_array_almost_equal(mean_img.get_data(),
+                                              this_data.mean(axis=-1),
+                                              decimal=5)
+            # 3D images are 4D images with one volume: as with numpy's
+            # mean, integers give float64
+            mean_data, _ = image._compute_mean(image.index_img(niimg, 0))
+            assert_equal(mean_data.dtype,
+                         this_data[..., :1].mean(axis=-1).dtype)
+            assert_array_equal(mean_data, this_data[..., 0])
+    finally:
+        image._STREAM_CHUNK_BYTES = chunk_bytes
+        shutil.rmtree(tmpdir)
+
+
 def test_mean_img_resample():
     # Test resampling in mean_img with a permutation of the axes
     rng = np.random.RandomState(42)
@@ -226,3 +343,223 @@ def test_mean_img_resample():
                        mean_img_with_resampling.get_affine())
     assert_array_equal(mean_img_with_resampling.get_affine(), target_affine)
 
+
+def test_running_stats():
+    rng = np.random.RandomState(42)
+    affine = np.diag((4, 3, 2, 1))
+    data1 = rng.rand(5, 6, 7, 11)
+    data2 = rng.rand(5, 6, 7) + 3
+    data3 = rng.rand(5, 6, 7, 4)
+    # Voxels with a zero variance
+    data1[0] = data2[0] = data3[0] = 1
+    niimgs = [nibabel.Nifti1Image(data, affine=affine)
+              for data in (data1, data2, data3)]
+
+    # Ground-truth: statistics over all the volumes
+    volumes = np.concatenate((data1, data2[..., np.newaxis], data3),
+                             axis=-1)
+    mean = volumes.mean(axis=-1)
+    std = volumes.std(axis=-1, ddof=1)
+
+    # Stream the volumes two by two
+    chunk_bytes = image._STREAM_CHUNK_BYTES
+    image._STREAM_CHUNK_BYTES = 2 * 8 * 5 * 6 * 7
+    try:
+        for n_jobs in (1, 2):
+            with testing.write_tmp_imgs(*niimgs) as imgs:
+                stats = image.running_stats(imgs, n_jobs=n_jobs)
+            assert_array_equal(stats['mean'].get_affine(), affine)
+            assert_array_almost_equal(stats['mean'].get_data(), mean)
+            assert_array_almost_equal(stats['var'].get_data(), std ** 2)
+            assert_array_almost_equal(stats['tsnr'].get_data()[1:],
+                                      mean[1:] / std[1:])
+            assert_array_almost_equal(stats['t'].get_data()[1:],
+                                      mean[1:] / std[1:] * np.sqrt(16))
+            assert_array_equal(stats['t'].get_data()[0], 0)
+    finally:
+        image._STREAM_CHUNK_BYTES = chunk_bytes
+
+    # Only the requested statistics are computed
+    stats = image.running_stats(niimgs[0], stats=('mean', ))
+    assert_equal(list(stats.keys()), ['mean'])
+    assert_array_almost_equal(stats['mean'].get_data(), data1.mean(axis=-1))
+
+    # Resampling to a permutation of the axes
+    target_affine = affine[:, [1, 0, 2, 3]]
+    stats = image.running_stats(niimgs[0], target_affine=target_affine)
+    assert_array_equal(stats['mean'].get_affine(), target_affine)
+    assert_array_almost_equal(
+        stats['var'].get_data(),
+        resampling.resample_img(
+            nibabel.Nifti1Image(data1.var(axis=-1, ddof=1), affine),
+            target_affine=target_affine).get_data())
+
+    assert_raises(ValueError, image.running_stats, niimgs, stats=('median', ))
+
+
+def test_math_img():
+    rng = np.random.RandomState(42)
+    affine = np.diag((4, 3, 2, 1))
+    data1 = rng.rand(5, 6, 7, 11)
+    data2 = rng.rand(5, 6, 7, 11)
+    data3 = rng.rand(5, 6, 7)
+    img1, img2, img3 = [nibabel.Nifti1Image(data, affine)
+                        for data in (data1, data2, data3)]
+
+    # Evaluate the formulas by chunks of 2 volumes or slices
+    chunk_bytes = image._STREAM_CHUNK_BYTES
+    image._STREAM_CHUNK_BYTES = 2 * 8 * 5 * 6 * 7 * 2
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for formula, truth in (
+                ('(a - b) / 2 + np.exp(-c)',
+                 (data1 - data2) / 2 + np.exp(-data3)[..., np.newaxis]),
+                ('np.where(a > b, a, -b) * 3',
+                 np.where(data1 > data2, data1, -data2) * 3),
+                ('abs(c - .5) ** 2', np.abs(data3 - .5) ** 2),
+                ('a * np.pi - e', data1 * np.pi - np.e),
+                ('c', data3)):
+            for output_file in (None, os.path.join(tmpdir, 'img.nii'),
+                                os.path.join(tmpdir, 'img.nii.gz')):
+                result = image.math_img(formula, output_file=output_file,
+                                        a=img1, b=img2, c=img3)
+                assert_array_equal(result.get_affine(), affine)
+                assert_array_almost_equal(result.get_data(), truth)
+    finally:
+        image._STREAM_CHUNK_BYTES = chunk_bytes
+        shutil.rmtree(tmpdir)
+
+    # The inputs are not modified
+    assert_array_equal(img1.get_data(), data1)
+    assert_array_equal(img3.get_data(), data3)
+
+    # Boolean results are stored as int8
+    result = image.math_img('(a > .5) & (c < .5)', a=img1, c=img3)
+    assert_equal(result.get_data().dtype, np.int8)
+    assert_array_equal(result.get_data(),
+                       (data1 > .5) & (data3 < .5)[..., np.newaxis])
+
+    for formula in ('a + d', 'np.mean(a)', 'a.sum()', '1 + 2',
+                    'lambda: a', 'a < b < c', 'a.T', 'a + newaxis',
+                    'a + np.newaxis', 'a + np', 'a + sqrt', 'a.b.exp(c)',
+                    'np.linalg.norm(a)'):
+        assert_raises(ValueError, image.math_img, formula,
+                      a=img1, b=img2, c=img3)
+    assert_raises(ValueError, image.math_img, 'a + b', a=img1,
+                  b=nibabel.Nifti1Image(data2, np.eye(4)))
+    assert_raises(ValueError, image.math_img, 'a + b', a=img1,
+                  b=nibabel.Nifti1Image(data2[..., :3], affine))
+
+
+def test_index_img():
+    rng = np.random.RandomState(42)
+    affine = np.diag((4, 3, 2, 1))
+    data = rng.rand(5, 6, 7, 10)
+    niimg = nibabel.Nifti1Image(data, affine)
+
+    # Slices and integers give views on in-memory data
+    for index in (slice(2, 5), slice(None, None, -3), 4, -1):
+        img = image.index_img(niimg, index)
+        assert_array_equal(img.get_affine(), affine)
+        assert_array_equal(img.get_data(), data[..., index])
+        assert_true(np.may_share_memory(img.get_data(), data))
+
+    with testing.write_tmp_imgs(niimg) as filename:
+        for img in (niimg, filename):
+            for index in (slice(2, 5), [1, 2, 3, 8, 0], 4,
+                          data[0, 0, 0] > .5, np.array([], dtype=int)):
+                indexed = image.index_img(img, index)
+                assert_array_equal(indexed.get_affine(), affine)
+                assert_array_almost_equal(indexed.get_data(),
+                                          data[..., index])
+            # Lazy selection: parts of the volumes can be read
+            indexed = image.index_img(img, [1, 2, 3, 8, 0])
+            assert_array_almost_equal(indexed.dataobj[..., 1:4],
+                                      data[..., [2, 3, 8]])
+            assert_array_almost_equal(indexed.dataobj[1, ..., 3],
+                                      data[1, ..., 8])
+            assert_array_almost_equal(image.mean_img(indexed).get_data(),
+                                      data[..., [1, 2, 3, 8, 0]].mean(-1))
+
+    # Scaled integer data: the values and their type are those of get_data()
+    int_niimg = nibabel.Nifti1Image((data * 100).astype(np.int16), affine)
+    int_niimg.get_header().set_slope_inter(.5, 2.)
+    with testing.write_tmp_imgs(int_niimg) as filename:
+        int_niimg = nibabel.load(filename)
+        scaled_data = int_niimg.get_data()
+        for index in ([1, 2, 8], []):
+            indexed = image.index_img(nibabel.load(filename), index)
+            assert_equal(indexed.get_data_dtype(), scaled_data.dtype)
+            assert_equal(indexed.get_data().dtype, scaled_data.dtype)
+            assert_array_equal(indexed.get_data(), scaled_data[..., index])
+
+    # List of 3D images
+    niimgs = [nibabel.Nifti1Image(data[..., i], affine) for i in range(10)]
+    assert_true(image.index_img(niimgs, 3) is niimgs[3])
+    assert_array_almost_equal(image.index_img(niimgs, [3, 1]).get_data(),
+                              data[..., [3, 1]])
+
+    assert_raises(TypeError, image.index_img, niimgs[0], 0)
+    assert_raises(IndexError, image.index_img, niimg, 10)
+
+
+def test_iter_img():
+    rng = np.random.RandomState(42)
+    affine = np.diag((4, 3, 2, 1))
+    data = rng.rand(5, 6, 7, 4)
+    niimg = nibabel.Nifti1Image(data, affine)
+    with testing.write_tmp_imgs(niimg) as filename:
+        for img in (niimg, filename):
+            volumes = list(image.iter_img(img))
+            assert_equal(len(volumes), 4)
+            for i, volume in enumerate(volumes):
+                assert_array_equal(volume.get_affine(), affine)
+                assert_array_almost_equal(volume.get_data(), data[..., i])
+    for volume in image.iter_img(niimg):
+        assert_true(np.may_share_memory(volume.get_data(), data))
+
+    # The data read from files can be modified, as with get_data()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for filename in (os.path.join(tmpdir, 'img.nii'),
+                         os.path.join(tmpdir, 'img.nii.gz')):
+            nibabel.save(niimg, filename)
+            for volume in (list(image.iter_img(filename))
+                           + [image.index_img(filename, 1),
+                              image.index_img(filename, [3, 0])]):
+                volume.get_data()[0, 0, 0] = -1
+                assert_true(np.all(volume.get_data()[0, 0, 0] == -1))
+    finally:
+        shutil.rmtree(tmpdir)
+    niimgs = [nibabel.Nifti1Image(data[..., i], affine) for i in range(4)]
+    assert_equal(list(image.iter_img(niimgs)), niimgs)
+    assert_raises(TypeError, list, image.iter_img(niimgs[0]))
+
+
+def test_threshold_img():
+    affine = np.diag((4, 3, 2, 1))
+    data = np.zeros((10, 11, 12))
+    data[1:4, 1:4, 1:4] = 3        # 27 voxels
+    data[5:7, 5:7, 5:7] = -3       # 8 voxels
+    data[7:9, 5:7, 5:7] = 3        # 8 voxels, touching the negative ones
+    data[9, 10, 11] = 5            # single voxel
+    data[1:4, 1:4, 5:8] = .5       # below threshold
+    niimg = nibabel.Nifti1Image(data, affine)
+
+    thresholded = image.threshold_img(niimg, 1)
+    assert_array_equal(thresholded.get_affine(), affine)
+    assert_array_equal(thresholded.get_data(),
+                       np.where(np.abs(data) > 1, data, 0))
+
+    # Positive and negative clusters are separate
+    thresholded = image.threshold_img(niimg, 1, cluster_size=9).get_data()
+    expected = np.zeros_like(data)
+    expected[1:4, 1:4, 1:4] = 3
+    assert_array_equal(thresholded, expected)
+    thresholded = image.threshold_img(niimg, 1, cluster_size=8).get_data()
+    expected[5:7, 5:7, 5:7] = -3
+    expected[7:9, 5:7, 5:7] = 3
+    assert_array_equal(thresholded, expected)
+
+    assert_raises(TypeError, image.threshold_img,
+                  nibabel.Nifti1Image(data[..., np.newaxis], affine), 1)
@@ -26,9 +26,11 @@ except ImportError:
 # from sklearn.utils.testing import assert_raise_message
 
 import numpy as np
+from scipy import ndimage
 
 from nibabel import Nifti1Image
 
+from .. import resampling
 from ..resampling import resample_img, BoundingBoxError, reorder_img, \
     from_matrix_vector, coord_transform
 from ..._utils import testing
@@ -406,6 +408,283 @@ def test_resampling_nan():
                 resampled_data[np.isfinite(resampled_data)])
 
 
+def test_resampling_plan():
+    # Test that 4D images, resampled with a plan computed once for all
+    # volumes, are resampled as each of their volumes
+    rng = np.random.RandomState(42)
+    data = rng.rand(7, 8, 9, 3)
+    source_img = Nifti1Image(data, np.eye(4))
+    for target_affine, target_shape in (
+            (np.diag((.8, 1.5, 1., 1.)), (9, 6, 10)),
+            (from_matrix_vector(rotation(.2, .4), [.5, -1., 1.]),
+             (8, 9, 7)),
+            (np.eye(3)[[2, 0, 1]], None)):
+        for interpolation in ('continuous', 'nearest'):
+            resampled = resample_img(source_img, target_affine=target_affine,
+                                     target_shape=target_shape,
+                                     interpolation=interpolation)
+            for i in range(data.shape[3]):
+                resampled_volume = resample_img(
+                    Nifti1Image(data[..., i], np.eye(4)),
+                    target_affine=target_affine, target_shape=target_shape,
+                    interpolation=interpolation)
+                assert_array_almost_equal(resampled.get_data()[..., i],
+                                          resampled_volume.get_data())
+
+    # Plans are reused
+    resampling._resampling_plans.clear()
+    resample_img(source_img, target_affine=np.diag((.8, 1.5, 1.)))
+    plan, = resampling._resampling_plans.values()
+    resample_img(source_img, target_affine=np.diag((.8, 1.5, 1.)))
+    assert_true(resampling._resampling_plans.values()[0] is plan)
+    resampling.clear_resampling_cache()
+    assert_equal(len(resampling._resampling_plans), 0)
+
+    # Plans too large to be kept are used for 4D images only
+    max_cached_plan_bytes = resampling._MAX_CACHED_PLAN_BYTES
+    resampling._MAX_CACHED_PLAN_BYTES = 100
+    try:
+        target_affine = from_matrix_vector(rotation(.2, .4), [.5, -1., 1.])
+        resampled = resample_img(source_img, target_affine=target_affine,
+                                 target_shape=(6, 7, 8),
+                                 interpolation='nearest')
+        assert_equal(len(resampling._resampling_plans), 0)
+        resampled_volume = resample_img(
+            Nifti1Image(data[..., 0], np.eye(4)), target_affine=target_affine,
+            target_shape=(6, 7, 8), interpolation='nearest')
+        assert_equal(len(resampling._resampling_plans), 0)
+        assert_array_equal(resampled.get_data()[..., 0],
+                           resampled_volume.get_data())
+    finally:
+        resampling._MAX_CACHED_PLAN_BYTES = max_cached_plan_bytes
+
+
+def test_resampling_n_jobs():
+    rng = np.random.RandomState(42)
+    data = rng.rand(7, 8, 9, 5)
+    target_affine = from_matrix_vector(rotation(.2, .4), [.5, -1., 1.])
+    for this_data in (data, data.reshape((7, 8, 9, 1, 5))):
+        source_img = Nifti1Image(this_data, np.eye(4))
+        resampled = resample_img(source_img, target_affine=target_affine,
+                                 target_shape=(8, 9, 7)).get_data()
+        for order in ('F', 'C'):
+            assert_array_almost_equal(
+                resample_img(source_img, target_affine=target_affine,
+                             target_shape=(8, 9, 7), order=order,
+                             n_jobs=2).get_data(),
+                resampled)
+    # Per-volume resampling, used with NaNs
+    data[0, 0, 0] = np.nan
+    source_img = Nifti1Image(data, np.eye(4))
+    resampled = assert_warns(RuntimeWarning, resample_img, source_img,
+                             target_affine=target_affine,
+                             target_shape=(8, 9, 7))
+    resampled_n_jobs = assert_warns(RuntimeWarning, resample_img, source_img,
+                                    target_affine=target_affine,
+                                    target_shape=(8, 9, 7), n_jobs=2)
+    assert_array_equal(resampled.get_data(), resampled_n_jobs.get_data())
+
+
+def test_resampling_nan_4d():
+    # NaNs at the same voxels in all the volumes are handled once for all
+    # the volumes, with the same result as for each volume
+    rng = np.random.RandomState(42)
+    data = rng.rand(7, 8, 9, 3)
+    data[:2] = np.nan
+    data[:, -1] = np.inf
+    target_affine = from_matrix_vector(rotation(.2, .4), [.5, -1., 1.])
+    for this_data in (data, data[..., :2]):
+        if this_data is not data:
+            # Different NaNs in each volume
+            this_data = this_data.copy()
+            this_data[3, 3, 3, 0] = np.nan
+        resampled = assert_warns(RuntimeWarning, resample_img,
+                                 Nifti1Image(this_data, np.eye(4)),
+                                 target_affine=target_affine,
+                                 target_shape=(8, 9, 7)).get_data()
+        for i in range(this_data.shape[-1]):
+            volume = assert_warns(RuntimeWarning, resample_img,
+                                  Nifti1Image(this_data[..., i], np.eye(4)),
+                                  target_affine=target_affine,
+                                  target_shape=(8, 9, 7)).get_data()
+            assert_array_equal(np.isnan(resampled[..., i]), np.isnan(volume))
+            assert_array_almost_equal(resampled[..., i][np.isfinite(volume)],
+                                      volume[np.isfinite(volume)])
+
+
+def test_resampling_dtype():
+    rng = np.random.RandomState(42)
+    data = rng.randint(-100, 100, size=(7, 8, 9, 20))
+    target_affine = from_matrix_vector(rotation(.2, .4), [.5, -1., 1.])
+    for dtype, interpolation, expected_dtype in (
+            (np.float32, 'continuous', np.float32),
+            (np.float64, 'continuous', np.float64),
+            (np.int16, 'continuous', np.float32),
+            (np.int16, 'nearest', np.int16),
+            (np.float32, 'nearest', np.float32)):
+        source_img = Nifti1Image(data.astype(dtype), np.eye(4))
+        resampled = resample_img(source_img, target_affine=target_affine,
+                                 target_shape=(8, 9, 7),
+                                 interpolation=interpolation).get_data()
+        assert_equal(resampled.dtype, expected_dtype)
+        # Same values as the resampling of each volume
+        for i in (0, 19):
+            volume = resample_img(Nifti1Image(data[..., i].astype(np.float64),
+                                              np.eye(4)),
+                                  target_affine=target_affine,
+                                  target_shape=(8, 9, 7),
+                                  interpolation=interpolation).get_data()
+            assert_array_almost_equal(resampled[..., i],
+                                      volume.astype(expected_dtype),
+                                      decimal=4)
+
+
+def test_resampling_cache_coefficients():
+    rng = np.random.RandomState(42)
+    for shape in ((7, 8, 9), (7, 8, 9, 3)):
+        data = rng.rand(*shape)
+        source_img = Nifti1Image(data, np.eye(4))
+        for theta in (.2, .4):
+            target_affine = from_matrix_vector(rotation(theta, .4),
+                                               [.5, -1., 1.])
+            resampled = resample_img(source_img, target_affine=target_affine,
+                                     target_shape=(8, 9, 7))
+            resampled_cached = resample_img(source_img,
+                                            target_affine=target_affine,
+                                            target_shape=(8, 9, 7),
+                                            cache_coefficients=True)
+            assert_array_almost_equal(resampled_cached.get_data(),
+                                      resampled.get_data())
+            # The coefficients are computed once for all the targets
+            assert_true(id(data) in resampling._spline_coefficients)
+            assert_equal(len(resampling._spline_coefficients), 1)
+        # and released with the data
+        del source_img, data
+        assert_equal(len(resampling._spline_coefficients), 0)
+
+
+def test_resampling_nearest():
+    # Nearest neighbor resampling gathers the data: the values and dtype
+    # are kept exactly
+    rng = np.random.RandomState(42)
+    labels = rng.randint(0, 10, size=(7, 8, 9)).astype(np.int64) + 2 ** 60
+    # Index (starting at 1) of the voxels of the source grid
+    index = np.arange(1., 7 * 8 * 9 + 1).reshape((7, 8, 9))
+    for matrix, offset in ((rotation(.2, .4), np.array([.5, -1., 1.])),
+                           (np.diag((.8, 1.5, 1.2)), np.array([0., 1., 0.]))):
+        target_affine = from_matrix_vector(matrix, offset)
+        # The voxels picked by ndimage (with the same parameters as
+        # resample_img)
+        if np.all(np.diag(np.diag(matrix)) == matrix):
+            expected_index = ndimage.affine_transform(
+                index, np.diag(matrix), offset=offset / np.diag(matrix),
+                output_shape=(8, 9, 7), order=0)
+        else:
+            expected_index = ndimage.affine_transform(
+                index, matrix, offset=offset, output_shape=(8, 9, 7),
+                order=0)
+        inside = expected_index > 0
+        for data in (labels, labels[..., np.newaxis] + [0, 1],
+                     (labels > 2 ** 60 + 4).astype(np.uint8)):
+            resampled = resample_img(Nifti1Image(data, np.eye(4)),
+                                     target_affine=target_affine,
+                                     target_shape=(8, 9, 7),
+                                     interpolation='nearest').get_data()
+            assert_equal(resampled.dtype, data.dtype)
+            flat_data = data.reshape((7 * 8 * 9, -1))
+            assert_array_equal(
+                resampled[inside].reshape((inside.sum(), -1)),
+                flat_data[expected_index[inside].astype(np.int) - 1])
+            assert_true(np.all(resampled[np.logical_not(inside)] == 0))
+
+
+def test_resampling_integer_grid():
+    # Crops, pads, subsamplings, flips and permutations are done by
+    # slicing, and give the same result as an interpolation
+    rng = np.random.RandomState(42)
+    data = rng.rand(7, 8, 9, 2)
+    affine = from_matrix_vector(np.diag((2., 3., 1.)), [10., -5., 2.])
+    source_img = Nifti1Image(data, affine)
+    for matrix, offset in (
+            (np.eye(3), (1, 2, -2)),                     # crop and pad
+            (np.diag((-1., 1., 1.)), (6, 0, 0)),         # flip
+            (np.eye(3)[[1, 2, 0]], (0, 0, 0)),           # permutation
+            (np.diag((2., 2., 3.)), (1, 0, 0)),          # subsampling
+            (np.eye(3)[[2, 0, 1]] * [1, -2, 1], (-3, 7, 1))):
+        target_affine = np.dot(affine, from_matrix_vector(matrix, offset))
+        target_shape = (5, 9, 4)
+        resampled = resample_img(source_img, target_affine=target_affine,
+                                 target_shape=target_shape)
+        # Compare to the value of the nearest voxel
+        i, j, k = np.indices(target_shape)
+        source_i, source_j, source_k = (
+            np.dot(matrix, np.array([i.ravel(), j.ravel(), k.ravel()]))
+            + np.asarray(offset)[:, np.newaxis]).astype(np.int)
+        inside = ((source_i >= 0) & (source_i < 7) & (source_j >= 0)
+                  & (source_j < 8) & (source_k >= 0) & (source_k < 9))
+        expected = np.zeros(target_shape + (2, ))
+        expected.reshape((-1, 2))[inside] = data[
+            source_i[inside], source_j[inside], source_k[inside]]
+        assert_array_equal(resampled.get_data(), expected)
+        np.testing.assert_array_almost_equal(resampled.get_affine(),
+                                             target_affine)
+
+    # Crops without copy are views
+    target_affine = np.dot(affine, from_matrix_vector(np.eye(3), (1, 1, 1)))
+    resampled = resample_img(source_img, target_affine=target_affine,
+                             target_shape=(3, 3, 3), copy=False)
+    assert_true(np.may_share_memory(resampled.get_data(), data))
+    resampled = resample_img(source_img, target_affine=target_affine,
+                             target_shape=(3, 3, 3))
+    assert_false(np.may_share_memory(resampled.get_data(), data))
+
+
+def test_resampling_target_mask():
+    # Resampling only the voxels of a mask gives the same values as
+    # resampling the whole grid and masking
+    rng = np.random.RandomState(42)
+    data = rng.rand(10, 12, 9, 3)
+    affine = from_matrix_vector(np.eye(3), [1., 2., 3.])
+    target_mask = rng.rand(8, 9, 10) > .5
+    rotation = np.array([[.9, .2, 0.], [-.2, .9, 0.], [0., 0., 1.3]])
+    for target_affine in (from_matrix_vector(np.diag((.8, 1.5, 1.2)),
+                                             [0., 0., 0.]),
+                          from_matrix_vector(rotation, [1., -2., .5]),
+                          from_matrix_vector(np.eye(3), [2., 3., 4.])):
+        for interpolation in ('continuous', 'nearest'):
+            for source_img in (Nifti1Image(data, affine),
+                               Nifti1Image(data[..., 0], affine)):
+                resampled = resample_img(
+                    source_img, target_affine=target_affine,
+                    target_shape=target_mask.shape,
+                    interpolation=interpolation).get_data()
+                expected = resampled[target_mask].T
+                masked = resample_img(source_img,
+                                      target_affine=target_affine,
+                                      target_mask=target_mask,
+                                      interpolation=interpolation)
+                assert_array_almost_equal(masked, expected)
+
+                # Without a plan, the voxels of the mask are interpolated
+                # volume per volume
+                max_plan_weights = resampling._MAX_PLAN_WEIGHTS
+                resampling._MAX_PLAN_WEIGHTS = 0
+                try:
+                    masked = resample_img(source_img,
+                                          target_affine=target_affine,
+                                          target_mask=target_mask,
+                                          interpolation=interpolation)
+                finally:
+                    resampling._MAX_PLAN_WEIGHTS = max_plan_weights
+                assert_array_almost_equal(masked, expected)
+
+    assert_raises(ValueError, resample_img, Nifti1Image(data, affine),
+                  target_affine=np.eye(3), target_mask=target_mask)
+    assert_raises(ValueError, resample_img, Nifti1Image(data, affine),
+                  target_affine=np.eye(4), target_shape=(3, 3, 3),
+                  target_mask=target_mask)
+
+
 def test_reorder_img():
     # We need to test on a square array, as rotation does not change
     # shape, whereas reordering does.
@@ -26,7 +26,8 @@ def filter_and_mask(niimgs, mask_img_,
                     memory=Memory(cachedir=None),
                     verbose=0,
                     confounds=None,
-                    copy=True):
+                    copy=True,
+                    n_jobs=1):
     # If we have a string (filename), we won't need to copy, as
     # there will be no side effect
 
@@ -49,28 +50,52 @@ def filter_and_mask(niimgs, mask_img_,
         (not np.allclose(niimgs.get_affine(), mask_img_.get_affine()))
      or (np.array(niimgs.shape[:3]) != np.array(mask_img_.shape)).any())
 
+    data = None
     if resampling_is_necessary:
         # now we can crop
-        mask_img_ = image.crop_img(mask_img_, copy=False)
-
-        niimgs = cache(image.resample_img, memory, ref_memory_level,
-                    memory_level=2, ignore=['copy'])(
-                        niimgs,
-                        target_affine=mask_img_.get_affine(),
-                        target_shape=mask_img_.shape,
-                        copy=copy)
-
-    # Load data (if filenames are given, load them)
-    if verbose > 0:
-        print("[%s] Loading data from %s" % (
-            class_name,
-            _utils._repr_niimgs(niimgs)[:200]))
-
-    # Get series from data with optional smoothing
-    if verbose > 1:
-        print("[%s] Masking and smoothing" % class_name)
-    data = masking.apply_mask(niimgs, mask_img_,
-                              smoothing_fwhm=parameters['smoothing_fwhm'])
+        mask_img_ = image.crop_img(mask_img_, copy=False,
+                                   cache_bounding_box=True)
+
+        if parameters['smoothing_fwhm'] is None:
+            # Without smoothing, only the voxels in the mask are needed:
+            # resampling and masking are done at once
+            if verbose > 1:
+                print("[%s] Resampling and masking" % class_name)
+            data = cache(image.resample_img, memory, ref_memory_level,
+                         memory_level=2, ignore=['copy', 'n_jobs'])(
+                             niimgs,
+                             target_affine=mask_img_.get_affine(),
+                             target_mask=_utils.as_ndarray(
+                                 mask_img_.get_data(), dtype=np.bool),
+                             copy=copy, n_jobs=n_jobs)
+            # Same output as masking.apply_mask
+            data = _utils.as_ndarray(
+                data, dtype=(data.dtype if data.dtype.kind == 'f'
+                             else np.float32),
+                copy=not data.flags.writeable)
+            data[np.logical_not(np.isfinite(data))] = 0
+            affine = mask_img_.get_affine()
+        else:
+            niimgs = cache(image.resample_img, memory, ref_memory_level,
+                        memory_level=2, ignore=['copy', 'n_jobs'])(
+                            niimgs,
+                            target_affine=mask_img_.get_affine(),
+                            target_shape=mask_img_.shape,
+                            copy=copy, n_jobs=n_jobs)
+
+    if data is None:
+        # Load data (if filenames are given, load them)
+        if verbose > 0:
+            print("[%s] Loading data from %s" % (
+                class_name,
+                _utils._repr_niimgs(niimgs)[:200]))
+
+        # Get series from data with optional smoothing
+        if verbose > 1:
+            print("[%s] Masking and smoothing" % class_name)
+        data = masking.apply_mask(niimgs, mask_img_,
+                                  smoothing_fwhm=parameters['smoothing_fwhm'])
+        affine = niimgs.get_affine()
 
     # Temporal
     # ========
@@ -117,7 +142,7 @@ def filter_and_mask(niimgs, mask_img_,
     # Optionally: 'doctor_nan', remove voxels with NaNs, other option
     # for later: some form of imputation
 
-    return data, niimgs.get_affine()
+    return data, affine
 
 
 def _safe_filter_and_mask(niimgs, mask_img_,
@@ -127,7 +152,8 @@ def _safe_filter_and_mask(niimgs, mask_img_,
                          verbose=0,
                          confounds=None,
                          reference_affine=None,
-                         copy=True):
+                         copy=True,
+                         n_jobs=1):
     niimgs = _utils.check_niimgs(niimgs, accept_3d=True)
 
     # If there is a reference affine, we may have to force resampling
@@ -141,7 +167,7 @@ def _safe_filter_and_mask(niimgs, mask_img_,
         parameters['target_affine'] = reference_affine
 
     return filter_and_mask(niimgs, mask_img_, parameters, ref_memory_level,
-            memory, verbose, confounds, copy)
+            memory, verbose, confounds, copy, n_jobs)
 
 
 class BaseMasker(BaseEstimator, TransformerMixin, CacheMixin):
@@ -156,18 +182,20 @@ class BaseMasker(BaseEstimator, TransformerMixin, CacheMixin):
         from .nifti_masker import NiftiMasker
         params = get_params(NiftiMasker, self)
         # Remove the mask-computing params: they are not useful and will
-        # just invalid the cache for no good reason
-        for name in ('mask', 'mask_args'):
+        # just invalid the cache for no good reason. n_jobs is given
+        # separately, and ignored by the cache.
+        for name in ('mask', 'mask_args', 'n_jobs'):
             params.pop(name, None)
         data, _ = self._cache(filter_and_mask, memory_level=1,
-                           ignore=['verbose', 'memory', 'copy'])(
+                           ignore=['verbose', 'memory', 'copy', 'n_jobs'])(
                               niimgs, self.mask_img_,
                               params,
                               ref_memory_level=self.memory_level,
                               memory=self.memory,
                               verbose=self.verbose,
                               confounds=confounds,
-                              copy=copy
+                              copy=copy,
+                              n_jobs=self.n_jobs
                             )
         return data
 
@@ -198,6 +226,8 @@ class BaseMasker(BaseEstimator, TransformerMixin, CacheMixin):
                              % self.__class__.__name__)
         from .nifti_masker import NiftiMasker
         params = get_params(NiftiMasker, self)
+        # Subjects are processed in parallel: each one uses a single thread
+        params.pop('n_jobs', None)
 
         reference_affine = None
         if self.target_affine is None:
@@ -206,7 +236,7 @@ class BaseMasker(BaseEstimator, TransformerMixin, CacheMixin):
             reference_affine = _utils.check_niimgs(niimgs_list[0]).get_affine()
 
         func = self._cache(_safe_filter_and_mask, memory_level=1,
-                           ignore=['verbose', 'memory', 'copy'])
+                           ignore=['verbose', 'memory', 'copy', 'n_jobs'])
         if confounds is None:
             confounds = itertools.repeat(None, len(niimgs_list))
         data = Parallel(n_jobs=n_jobs)(delayed(func)(
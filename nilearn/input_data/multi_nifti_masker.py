@@ -76,9 +76,11 @@ class MultiNiftiMasker(BaseMasker, CacheMixin):
         By default, no caching is done. If a string is given, it is the
         path to the caching directory.
 
-    memory_level: integer, optional
+    memory_level: integer or 'adaptive', optional
         Rough estimator of the amount of memory used by caching. Higher value
-        means more memory for caching.
+        means more memory for caching. If 'adaptive', functions are cached
+        depending on their measured cost (see
+        nilearn.cache_adaptive_threshold).
 
     n_jobs: integer, optional
         The number of CPUs to use to do the computation. -1 means
@@ -78,9 +78,15 @@ class NiftiMasker(BaseMasker, CacheMixin):
         By default, no caching is done. If a string is given, it is the
         path to the caching directory.
 
-    memory_level : integer, optional
+    memory_level : integer or 'adaptive', optional
         Rough estimator of the amount of memory used by caching. Higher value
-        means more memory for caching.
+        means more memory for caching. If 'adaptive', functions are cached
+        depending on their measured cost (see
+        nilearn.cache_adaptive_threshold).
+
+    n_jobs : integer, optional
+        The number of threads used to resample the images in transform().
+        -1 means 'all cpus'.
 
     verbose : integer, optional
         Indicate the level of verbosity. By default, nothing is printed
@@ -110,7 +116,7 @@ class NiftiMasker(BaseMasker, CacheMixin):
                  mask_strategy='background',
                  mask_args=None,
                  memory_level=1, memory=Memory(cachedir=None),
-                 verbose=0
+                 n_jobs=1, verbose=0
                  ):
         # Mask is provided or computed
         self.mask = mask
@@ -129,6 +135,7 @@ class NiftiMasker(BaseMasker, CacheMixin):
 
         self.memory = memory
         self.memory_level = memory_level
+        self.n_jobs = n_jobs
         self.verbose = verbose
 
     def fit(self, niimgs=None, y=None):
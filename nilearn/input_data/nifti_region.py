@@ -91,9 +91,15 @@ class NiftiLabelsMasker(BaseEstimator, TransformerMixin, CacheMixin):
         By default, no caching is done. If a string is given, it is the
         path to the caching directory.
 
-    memory_level: int, optional
+    memory_level: int or 'adaptive', optional
         Aggressiveness of memory caching. The higher the number, the higher
         the number of functions that will be cached. Zero means no caching.
+        If 'adaptive', functions are cached depending on their measured
+        cost (see nilearn.cache_adaptive_threshold).
+
+    n_jobs: integer, optional
+        The number of threads used to resample the images in transform().
+        -1 means 'all cpus'.
 
     verbose: integer, optional
         Indicate the level of verbosity. By default, nothing is printed
@@ -115,7 +121,7 @@ class NiftiLabelsMasker(BaseEstimator, TransformerMixin, CacheMixin):
                  low_pass=None, high_pass=None, t_r=None,
                  resampling_target="labels",
                  memory=Memory(cachedir=None, verbose=0), memory_level=1,
-                 verbose=0):
+                 n_jobs=1, verbose=0):
         self.labels_img = labels_img
         self.background_label = background_label
         self.mask_img = mask_img
@@ -136,6 +142,7 @@ class NiftiLabelsMasker(BaseEstimator, TransformerMixin, CacheMixin):
         # Parameters for joblib
         self.memory = memory
         self.memory_level = memory_level
+        self.n_jobs = n_jobs
         self.verbose = verbose
 
         if resampling_target not in ("labels", None):
@@ -191,6 +198,9 @@ class NiftiLabelsMasker(BaseEstimator, TransformerMixin, CacheMixin):
 
             mask_data, mask_affine = masking._load_mask_img(self.mask_img_)
 
+        # Computed by the first call to inverse_transform, with the
+        # background label used
+        self._labels_mapping = (None, None)
         return self
 
     def fit_transform(self, niimgs, confounds=None):
@@ -223,10 +233,12 @@ class NiftiLabelsMasker(BaseEstimator, TransformerMixin, CacheMixin):
 
         if self.resampling_target == "labels":
             logger.log("resampling images", verbose=self.verbose)
-            niimgs = self._cache(image.resample_img, memory_level=1)(
+            niimgs = self._cache(image.resample_img, memory_level=1,
+                                 ignore=['n_jobs'])(
                 niimgs, interpolation="continuous",
                 target_shape=_utils._get_shape(self.labels_img_),
-                target_affine=self.labels_img_.get_affine())
+                target_affine=self.labels_img_.get_affine(),
+                n_jobs=self.n_jobs)
 
         if self.smoothing_fwhm is not None:
             logger.log("smoothing images", verbose=self.verbose)
@@ -268,9 +280,23 @@ class NiftiLabelsMasker(BaseEstimator, TransformerMixin, CacheMixin):
             shape: (number of scans, number of voxels)
         """
         logger.log("computing image from signals", verbose=self.verbose)
-        return region.signals_to_img_labels(
-            signals, self.labels_img_, self.mask_img_,
-            background_label=self.background_label)
+        # The labels are only looked up once: the mapping of the voxels to
+        # the regions is reused by the following calls (with the same
+        # background label).
+        background_label, mapping = getattr(self, "_labels_mapping",
+                                            (None, None))
+        if mapping is None or background_label != self.background_label:
+            mask_data = None
+            if self.mask_img_ is not None:
+                mask_data = self.mask_img_.get_data()
+            mapping = region._labels_mapping(
+                self.labels_img_.get_data(), mask_data=mask_data,
+                background_label=self.background_label)
+            self._labels_mapping = (self.background_label, mapping)
+        return region._signals_to_img_labels(
+            signals, mapping,
+            _utils._get_shape(self.labels_img_)[:3],
+            self.labels_img_.get_affine())
 
 
 class NiftiMapsMasker(BaseEstimator, TransformerMixin, CacheMixin):
@@ -320,9 +346,15 @@ class NiftiMapsMasker(BaseEstimator, TransformerMixin, CacheMixin):
         By default, no caching is done. If a string is given, it is the
         path to the caching directory.
 
-    memory_level: int, optional
+    memory_level: int or 'adaptive', optional
         Aggressiveness of memory caching. The higher the number, the higher
         the number of functions that will be cached. Zero means no caching.
+        If 'adaptive', functions are cached depending on their measured
+        cost (see nilearn.cache_adaptive_threshold).
+
+    n_jobs: integer, optional
+        The number of threads used to resample the images in transform().
+        -1 means 'all cpus'.
 
     verbose: integer, optional
         Indicate the level of verbosity. By default, nothing is printed
@@ -345,7 +377,7 @@ class NiftiMapsMasker(BaseEstimator, TransformerMixin, CacheMixin):
                  low_pass=None, high_pass=None, t_r=None,
                  resampling_target="maps",
                  memory=Memory(cachedir=None, verbose=0), memory_level=0,
-                 verbose=0):
+                 n_jobs=1, verbose=0):
         self.maps_img = maps_img
         self.mask_img = mask_img
 
@@ -365,6 +397,7 @@ class NiftiMapsMasker(BaseEstimator, TransformerMixin, CacheMixin):
         # Parameters for joblib
         self.memory = memory
         self.memory_level = memory_level
+        self.n_jobs = n_jobs
         self.verbose = verbose
 
         if resampling_target not in ("mask", "maps", None):
@@ -467,17 +500,21 @@ class NiftiMapsMasker(BaseEstimator, TransformerMixin, CacheMixin):
 
         if self.resampling_target == "mask":
             logger.log("resampling images to fit mask", verbose=self.verbose)
-            niimgs = self._cache(image.resample_img, memory_level=1)(
+            niimgs = self._cache(image.resample_img, memory_level=1,
+                                 ignore=['n_jobs'])(
                 niimgs, interpolation="continuous",
                 target_shape=_utils._get_shape(self.mask_img_),
-                target_affine=self.mask_img_.get_affine())
+                target_affine=self.mask_img_.get_affine(),
+                n_jobs=self.n_jobs)
 
         if self.resampling_target == "maps":
             logger.log("resampling images to fit maps", verbose=self.verbose)
-            niimgs = self._cache(image.resample_img, memory_level=1)(
+            niimgs = self._cache(image.resample_img, memory_level=1,
+                                 ignore=['n_jobs'])(
                 niimgs, interpolation="continuous",
                 target_shape=_utils._get_shape(self.maps_img_)[:3],
-                target_affine=self.maps_img_.get_affine())
+                target_affine=self.maps_img_.get_affine(),
+                n_jobs=self.n_jobs)
 
         if self.smoothing_fwhm is not None:
             logger.log("smoothing images", verbose=self.verbose)
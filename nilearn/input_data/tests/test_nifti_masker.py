@@ -112,3 +112,18 @@ def test_joblib_cache():
         mask_hash = hash(masker.mask_img_)
         masker.mask_img_.get_data()
         assert_true(mask_hash == hash(masker.mask_img_))
+
+
+def test_n_jobs():
+    # Images are resampled in parallel threads, with the same result
+    rng = np.random.RandomState(0)
+    img = Nifti1Image(rng.rand(10, 11, 12, 5), np.eye(4))
+    mask = np.zeros((5, 6, 6), dtype=np.int8)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    mask_img = Nifti1Image(mask, np.diag((2, 2, 2, 1)))
+    for smoothing_fwhm in (None, 2.):
+        signals = [NiftiMasker(mask=mask_img, smoothing_fwhm=smoothing_fwhm,
+                               n_jobs=n_jobs).fit().transform(img)
+                   for n_jobs in (1, 2)]
+        assert_true(signals[0].shape == (5, mask.sum()))
+        np.testing.assert_array_almost_equal(signals[0], signals[1])
@@ -11,6 +11,7 @@ import numpy as np
 import nibabel
 
 from ..nifti_region import NiftiLabelsMasker, NiftiMapsMasker
+from ... import region
 from ..._utils import testing
 from ..._utils import as_ndarray
 
@@ -84,6 +85,14 @@ def test_nifti_labels_masker():
     np.testing.assert_almost_equal(fmri11_img_r.get_affine(),
                                    fmri11_img.get_affine())
 
+    # The regions follow a change of the background label
+    masker11.set_params(background_label=1)
+    fmri11_img_r = masker11.inverse_transform(signals11)
+    np.testing.assert_array_equal(
+        fmri11_img_r.get_data(),
+        region.signals_to_img_labels(signals11, labels11_img,
+                                     background_label=1).get_data())
+
 
 def test_nifti_labels_masker_2():
     # Test resampling in NiftiLabelsMasker
@@ -13,7 +13,7 @@ from sklearn.externals.joblib import Parallel, delayed
 from . import _utils
 from ._utils.cache_mixin import cache
 from ._utils.ndimage import largest_connected_component
-from ._utils.niimg_conversions import _safe_get_data
+from ._utils.niimg_conversions import _unscaled_data
 
 
 class MaskWarning(UserWarning):
@@ -64,6 +64,9 @@ def _load_mask_img(mask_img, allow_empty=False):
 
 def _extrapolate_out_mask(data, mask, iterations=1):
     """ Extrapolate values outside of the mask.
+
+    The data can have more dimensions than the (3D) mask, eg several
+    volumes sharing the same mask: they are all extrapolated at once.
     """
     if iterations > 1:
         data, mask = _extrapolate_out_mask(data, mask,
@@ -72,8 +75,8 @@ def _extrapolate_out_mask(data, mask, iterations=1):
     larger_mask = np.zeros(np.array(mask.shape) + 2, dtype=np.bool)
     larger_mask[1:-1, 1:-1, 1:-1] = mask
     # Use nans as missing value: ugly
-    masked_data = np.zeros(larger_mask.shape)
-    masked_data[1:-1, 1:-1, 1:-1] = data.copy()
+    masked_data = np.zeros(larger_mask.shape + data.shape[3:])
+    masked_data[1:-1, 1:-1, 1:-1] = data
     masked_data[np.logical_not(larger_mask)] = np.nan
     outer_shell = larger_mask.copy()
     outer_shell[1:-1, 1:-1, 1:-1] = new_mask - mask
@@ -514,7 +517,8 @@ def compute_multi_background_mask(data_imgs, border_size=2, upper_cutoff=0.85,
 #
 
 def apply_mask(niimgs, mask_img, dtype='f',
-               smoothing_fwhm=None, ensure_finite=True):
+               smoothing_fwhm=None, ensure_finite=True,
+               masked_smoothing=False):
     """Extract signals from images using specified mask.
 
     Read the time series from the given nifti images or filepaths,
@@ -531,7 +535,10 @@ def apply_mask(niimgs, mask_img, dtype='f',
     dtype: numpy dtype or 'f'
         The dtype of the output, if 'f', any float output is acceptable
         and if the data is stored on the disk as floats the data type
-        will not be changed.
+        will not be changed. Scaled data (scl_slope and scl_inter set in
+        the header) has the type of the values returned by get_data()
+        (float64 for images loaded from a file, float32 for 3D images
+        concatenated by nilearn), other data is converted to float32.
 
     smoothing_fwhm: float
         (optional) Gives the size of the spatial smoothing to apply to
@@ -541,6 +548,14 @@ def apply_mask(niimgs, mask_img, dtype='f',
         If ensure_finite is True (default), the non-finite values (NaNs and
         infs) found in the images will be replaced by zeros.
 
+    masked_smoothing: bool
+        If True, only the voxels of the mask are smoothed: the values
+        outside of the mask are ignored, and the smoothed signal is
+        normalized by the smoothed mask, so that the signal is not
+        attenuated at the edges of the mask. Only the bounding box of the
+        mask (padded by the width of the smoothing kernel) is loaded and
+        smoothed.
+
     Returns
     --------
     session_series: numpy.ndarray
@@ -556,11 +571,26 @@ def apply_mask(niimgs, mask_img, dtype='f',
                            mask_affine)
     return _apply_mask_fmri(niimgs, mask_img, dtype=dtype,
                             smoothing_fwhm=smoothing_fwhm,
-                            ensure_finite=ensure_finite)
+                            ensure_finite=ensure_finite,
+                            masked_smoothing=masked_smoothing)
+
+
+def _mask_bounding_box(mask, padding):
+    """ Slices of the bounding box of the mask, padded by the given number
+        of voxels along each axis (within the bounds of the mask array).
+    """
+    slices = []
+    for axis, axis_padding in enumerate(padding):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        indices = np.where(np.any(mask, axis=other_axes))[0]
+        slices.append(slice(max(indices[0] - axis_padding, 0),
+                            indices[-1] + 1 + axis_padding))
+    return tuple(slices)
 
 
 def _apply_mask_fmri(niimgs, mask_img, dtype='f',
-                     smoothing_fwhm=None, ensure_finite=True):
+                     smoothing_fwhm=None, ensure_finite=True,
+                     masked_smoothing=False):
     """Same as apply_mask().
 
     The only difference with apply_mask is that some costly checks on mask_img
@@ -588,22 +618,67 @@ def _apply_mask_fmri(niimgs, mask_img, dtype='f',
         raise ValueError('Mask shape: %s is different from img shape:%s'
                          % (str(mask_data.shape), str(niimgs_img.shape[:3])))
 
-    # All the following has been optimized for C order.
-    # Time that may be lost in conversion here is regained multiple times
-    # afterward, especially if smoothing is applied.
-    series = _safe_get_data(niimgs_img)
+    # Scaling (scl_slope, scl_inter) is applied at the same time as the
+    # conversion to floats, and after masking if no smoothing is
+    # required: the data is loaded in its (smaller) stored dtype.
+    series, slopes, inters = _unscaled_data(niimgs_img)
 
     if dtype == 'f':
-        if series.dtype.kind == 'f':
+        if slopes is not None:
+            # Same type as the scaled values returned by get_data()
+            dtype = slopes.dtype
+        elif series.dtype.kind == 'f':
             dtype = series.dtype
         else:
             dtype = np.float32
-    series = _utils.as_ndarray(series, dtype=dtype, order="C",
-                               copy=True)
     del niimgs_img  # frees a lot of memory
 
+    if smoothing_fwhm is None:
+        series = _utils.as_ndarray(series[mask_data], dtype=dtype,
+                                   copy=True)
+        if slopes is not None:
+            series *= slopes
+            series += inters
+        if ensure_finite:
+            series[np.logical_not(np.isfinite(series))] = 0
+        return series.T
+
     # Delayed import to avoid circular imports
     from .image.image import _smooth_array
+
+    if masked_smoothing:
+        # Voxels further from the mask than the radius of the smoothing
+        # kernel (as in ndimage.gaussian_filter) play no part
+        sigma = (smoothing_fwhm / np.sqrt(8 * np.log(2))
+                 / np.sqrt(np.sum(affine ** 2, axis=0)))
+        box = _mask_bounding_box(
+            mask_data, (np.ones(3) * (4 * sigma + .5)).astype(int))
+        series = series[box]
+        mask_data = mask_data[box]
+
+    # All the following has been optimized for C order.
+    # Time that may be lost in conversion here is regained multiple times
+    # afterward, especially if smoothing is applied.
+    series = _utils.as_ndarray(series, dtype=dtype, order="C",
+                               copy=True)
+    if slopes is not None:
+        series *= slopes
+        series += inters
+
+    if masked_smoothing:
+        series[np.logical_not(np.isfinite(series))] = 0
+        series[np.logical_not(mask_data)] = 0
+        _smooth_array(series, affine, fwhm=smoothing_fwhm,
+                      ensure_finite=False, copy=False)
+        # Normalized convolution: divide by the weight of the voxels of
+        # the mask in the smoothing of each voxel
+        weights = _smooth_array(mask_data.astype(series.dtype), affine,
+                                fwhm=smoothing_fwhm, ensure_finite=False,
+                                copy=False)
+        series = series[mask_data]
+        series /= weights[mask_data][:, np.newaxis]
+        return series.T
+
     _smooth_array(series, affine, fwhm=smoothing_fwhm,
                   ensure_finite=ensure_finite, copy=False)
     return series[mask_data].T
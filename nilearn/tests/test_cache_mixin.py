@@ -5,10 +5,16 @@ import os
 import shutil
 import tempfile
 import json
+import time
+import socket
 
-from nose.tools import assert_false, assert_true
+from nose.tools import assert_false, assert_true, assert_equal, \
+    assert_raises
 
-from sklearn.externals.joblib import Memory
+import numpy as np
+import nibabel
+
+from sklearn.externals.joblib import Memory, Parallel, delayed
 
 import nilearn
 from .._utils import cache_mixin
@@ -70,3 +76,362 @@ def test__safe_cache_flush():
         #if os.path.exists(temp_dir):
         #    shutil.rmtree(temp_dir)
 
+
+
+def test_cache_prune():
+    # Test that the least recently used entries are removed
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # Test the disk cache only
+        nilearn.cache_memory_entries = 0
+        mem = Memory(cachedir=temp_dir, verbose=0)
+        cached_f = cache_mixin.cache(f, mem, ref_memory_level=2,
+                                     memory_level=1)
+        for x in range(3):
+            cached_f(np.ones(1000) * x)
+        info = cache_mixin.cache_info(temp_dir)
+        assert_equal(info['n_entries'], 3)
+        assert_equal(len(info['functions']), 1)
+        assert_true(info['size'] > 3 * 8000)
+        entry_size = info['size'] / 3
+
+        # Make the first entry the most recently used one
+        entries = sorted(cache_mixin._cache_entries(mem.cachedir),
+                         key=lambda entry: entry[2])
+        for n, (path, _, _) in enumerate(entries):
+            os.utime(path, (n, n))
+        cached_f(np.ones(1000) * 0)
+
+        removed = nilearn.cache_prune(temp_dir, bytes_limit=entry_size + 1)
+        assert_equal(removed, 2 * entry_size)
+        info = cache_mixin.cache_info(temp_dir)
+        assert_equal(info['n_entries'], 1)
+        assert_true(os.path.exists(entries[0][0]))
+
+        # Automatic pruning
+        nilearn.cache_bytes_limit = 2 * entry_size + 1
+        for x in range(3, 6):
+            cached_f(np.ones(1000) * x)
+        assert_equal(cache_mixin.cache_info(temp_dir)['n_entries'], 2)
+        # The result of a cached call is correct
+        np.testing.assert_array_equal(cached_f(np.ones(1000) * 5),
+                                      np.ones(1000) * 5)
+    finally:
+        nilearn.cache_memory_entries = 0
+        nilearn.cache_bytes_limit = None
+        cache_mixin._cache_sizes.clear()
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+def _double_img(img):
+    _double_img.n_calls += 1
+    img = nibabel.load(img) if isinstance(img, basestring) else img
+    return nibabel.Nifti1Image(2 * img.get_data(), img.get_affine())
+
+_double_img.n_calls = 0
+
+
+def _first_volume(img):
+    return nibabel.Nifti1Image(img.get_data()[..., 0], img.get_affine())
+
+
+def test_cache_keys():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, 'img.nii')
+        nibabel.save(nibabel.Nifti1Image(np.ones((3, 4, 5)), np.eye(4)),
+                     filename)
+        img = nibabel.load(filename)
+        key = cache_mixin._cache_key(img)
+        assert_equal(key[0], 'niimg')
+        assert_equal(key[2], os.path.realpath(filename))
+        # Computing the key did not load the data
+        assert_true(img._data_cache is None)
+        assert_equal(cache_mixin._cache_key(filename)[0], 'file')
+        # In-memory images are hashed as usual
+        in_memory_img = nibabel.Nifti1Image(np.ones((3, 4, 5)), np.eye(4))
+        assert_true(cache_mixin._cache_key(in_memory_img) is in_memory_img)
+
+        mem = Memory(cachedir=os.path.join(temp_dir, 'cache'), verbose=0)
+        cached_double = cache_mixin.cache(_double_img, mem,
+                                          ref_memory_level=2)
+        _double_img.n_calls = 0
+        doubled = cached_double(img)
+        cached_double(nibabel.load(filename))
+        assert_equal(_double_img.n_calls, 1)
+        # Images returned by cached functions have a provenance key
+        key = cache_mixin._cache_key(doubled)
+        assert_equal(key[0], 'derived')
+        cached_double(doubled)
+        assert_equal(_double_img.n_calls, 2)
+        # Its data was only read by the cached function: it keeps its
+        # provenance key, which does not read the data
+        assert_true(doubled._data_cache is None)
+        assert_equal(cache_mixin._cache_key(doubled), key)
+        cached_double(cached_double(nibabel.load(filename)))
+        assert_equal(_double_img.n_calls, 2)
+        # Modifying a derived image in place changes its key
+        doubled = cached_double(nibabel.load(filename))
+        doubled.get_data()[0, 0, 0] = 0
+        quadrupled = cached_double(doubled)
+        assert_equal(_double_img.n_calls, 3)
+        assert_equal(quadrupled.get_data()[0, 0, 0], 0)
+        assert_equal(quadrupled.get_data()[1, 0, 0], 4)
+        assert_false(hasattr(doubled, '_nilearn_provenance'))
+        # Outputs sharing data with a derived input may modify it
+        cached_first = cache_mixin.cache(_first_volume, mem,
+                                         ref_memory_level=2)
+        doubled = cached_double(nibabel.load(filename))
+        cached_first(doubled)
+        assert_false(hasattr(doubled, '_nilearn_provenance'))
+
+        # Modifying the file invalidates the cache
+        nibabel.save(nibabel.Nifti1Image(np.zeros((3, 4, 5, 2)),
+                                         np.eye(4)), filename)
+        doubled = cached_double(nibabel.load(filename))
+        assert_equal(_double_img.n_calls, 4)
+        assert_equal(doubled.shape, (3, 4, 5, 2))
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+def test_cache_stats():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # Test the disk cache only
+        nilearn.cache_memory_entries = 0
+        nilearn.cache_stats_reset()
+        mem = Memory(cachedir=temp_dir, verbose=0)
+        cached_f = cache_mixin.cache(f, mem, ref_memory_level=2)
+        for x in (1, 2, 1, 1):
+            cached_f(np.ones(100) * x)
+        stats = nilearn.cache_stats()
+        assert_equal(len(stats), 1)
+        func_name, func_stats = stats.items()[0]
+        assert_true(func_name.endswith('f'))
+        assert_equal(func_stats['hits'], 2)
+        assert_equal(func_stats['misses'], 2)
+        assert_true(func_stats['bytes_stored'] > 2 * 800)
+        assert_true(func_stats['load_time'] > 0)
+        assert_equal(func_stats, nilearn.cache_stats(func_name))
+
+        # Dump at exit
+        stats_file = os.path.join(temp_dir, 'stats.json')
+        nilearn.cache_stats_file = stats_file
+        cache_mixin._dump_cache_stats()
+        with open(stats_file) as stats_file:
+            assert_equal(json.load(stats_file)[func_name]['hits'], 2)
+
+        nilearn.cache_stats_reset()
+        assert_equal(nilearn.cache_stats(), {})
+    finally:
+        nilearn.cache_memory_entries = 0
+        nilearn.cache_stats_file = None
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+def test_cache_adaptive():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # Test the disk cache only
+        nilearn.cache_memory_entries = 0
+        nilearn.cache_stats_reset()
+        nilearn.cache_adaptive_threshold = 1.e12
+        mem = Memory(cachedir=temp_dir, verbose=0)
+        cached_f = cache_mixin.cache(f, mem, ref_memory_level='adaptive')
+        data = np.ones(1000)
+        # The first calls are cached to measure the cost of the function
+        for _ in range(cache_mixin._ADAPTIVE_MIN_CALLS):
+            cached_f(data)
+        func_name = cached_f.func_name
+        assert_equal(nilearn.cache_stats(func_name)['hits'],
+                     cache_mixin._ADAPTIVE_MIN_CALLS - 1)
+        stats_file = os.path.join(mem.cachedir,
+                                  cache_mixin._ADAPTIVE_STATS_FILENAME)
+        # Costs are written in the cache directory in batches
+        assert_false(os.path.exists(stats_file))
+        cache_mixin._flush_adaptive_stats()
+        with open(stats_file) as this_file:
+            n_calls, _, nbytes = json.load(this_file)[func_name]
+        assert_equal(n_calls, 1)
+        assert_equal(nbytes, data.nbytes)
+
+        # Measured costs are shared with other processes through the cache
+        cache_mixin._update_adaptive_stats(mem.cachedir, func_name, 0., 8000)
+        cache_mixin._update_adaptive_stats(mem.cachedir, func_name, 0., 8000)
+        cache_mixin._flush_adaptive_stats(mem.cachedir)
+        cache_mixin._adaptive_stats.clear()
+        # The function is cheap: it is not cached anymore
+        np.testing.assert_array_equal(cached_f(data * 2), data * 2)
+        assert_equal(nilearn.cache_stats(func_name)['misses'], 1)
+        assert_equal(cache_mixin.cache_info(temp_dir)['n_entries'], 1)
+        # Calls not cached do not write in the cache directory
+        mtime = os.stat(stats_file).st_mtime
+        time.sleep(.01)
+        cached_f(data * 3)
+        assert_equal(os.stat(stats_file).st_mtime, mtime)
+        assert_equal(cache_mixin._adaptive_stats[mem.cachedir][func_name][0],
+                     5)
+
+        # An expensive function is still cached
+        nilearn.cache_adaptive_threshold = 0.
+        cached_f(data * 2)
+        assert_equal(nilearn.cache_stats(func_name)['misses'], 2)
+    finally:
+        nilearn.cache_memory_entries = 0
+        nilearn.cache_adaptive_threshold = 0.01
+        cache_mixin._adaptive_stats.clear()
+        cache_mixin._adaptive_pending.clear()
+        nilearn.cache_stats_reset()
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+def test_cache_mmap_output():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        nilearn.cache_mmap_min_bytes = 1000
+        mem = Memory(cachedir=temp_dir, verbose=0)
+        cached_f = cache_mixin.cache(f, mem, ref_memory_level=2)
+        data = np.arange(1000.)
+        img = nibabel.Nifti1Image(np.ones((10, 10, 10)), np.eye(4))
+        output = (data, np.arange(3), img, 'text')
+        cached_f(output)
+        cached_output = cached_f(output)
+        # Large arrays are reloaded as read-only memmaps
+        assert_true(isinstance(cached_output[0], np.memmap))
+        assert_equal(cached_output[0].mode, 'r')
+        np.testing.assert_array_equal(cached_output[0], data)
+        assert_false(isinstance(cached_output[1], np.memmap))
+        np.testing.assert_array_equal(cached_output[1], np.arange(3))
+        assert_true(isinstance(cached_output[2].get_data(), np.memmap))
+        np.testing.assert_array_equal(cached_output[2].get_data(),
+                                      img.get_data())
+        assert_equal(cached_output[3], 'text')
+        entries = cache_mixin._cache_entries(mem.cachedir)
+        assert_equal(len(entries), 1)
+        assert_true(os.path.exists(os.path.join(
+            entries[0][0], cache_mixin._MMAP_OUTPUT_FILENAME)))
+
+        # Outputs without large arrays use the joblib format
+        cached_f(np.arange(3))
+        np.testing.assert_array_equal(cached_f(np.arange(3)), np.arange(3))
+        assert_equal(len(cache_mixin._cache_entries(mem.cachedir)), 2)
+    finally:
+        nilearn.cache_mmap_min_bytes = None
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+def _slow_f(x, log_dir):
+    # Record each call in a file, shared between processes
+    with open(os.path.join(log_dir, 'calls.log'), 'a') as log:
+        log.write('x')
+    time.sleep(.5)
+    return x
+
+
+def _call(func, *args):
+    return func(*args)
+
+
+def test_cache_concurrent_calls():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        log_dir = os.path.join(temp_dir, 'log')
+        os.mkdir(log_dir)
+        mem = Memory(cachedir=temp_dir, verbose=0)
+        cached_f = cache_mixin.cache(_slow_f, mem, ref_memory_level=2)
+        outputs = Parallel(n_jobs=4)(delayed(_call)(cached_f, 1, log_dir)
+                                     for _ in range(4))
+        assert_equal(outputs, [1] * 4)
+        # The function has been computed only once
+        with open(os.path.join(log_dir, 'calls.log')) as log:
+            assert_equal(log.read(), 'x')
+        func_dir = cached_f._get_func_dir()
+        # Only the entry is left in the cache directory
+        assert_equal(sorted(os.listdir(func_dir)),
+                     sorted(['func_code.py',
+                             cached_f._get_output_dir(1, log_dir)[1]]))
+
+        # A lock left by a dead process does not block the cache
+        output_dir = cached_f._get_output_dir(2, log_dir)[0]
+        with open(output_dir + cache_mixin._LOCK_SUFFIX, 'w') as lock:
+            lock.write('%s %i' % (socket.gethostname(), 2 ** 22 + 1))
+        assert_true(cache_mixin._lock_is_stale(
+            output_dir + cache_mixin._LOCK_SUFFIX))
+        assert_equal(cached_f(2, log_dir), 2)
+        assert_false(os.path.exists(output_dir + cache_mixin._LOCK_SUFFIX))
+
+        # The age of a lock only matters for processes on other hosts,
+        # and the lock is refreshed by the process holding it
+        lock_filename = output_dir + cache_mixin._LOCK_SUFFIX
+        old_time = time.time() - 2 * cache_mixin._LOCK_TIMEOUT
+        for hostname, pid, stale in ((socket.gethostname(), os.getpid(),
+                                      False),
+                                     ('unknown-host', 1, True)):
+            with open(lock_filename, 'w') as lock:
+                lock.write('%s %i' % (hostname, pid))
+            os.utime(lock_filename, (old_time, old_time))
+            assert_equal(cache_mixin._lock_is_stale(lock_filename), stale)
+        refresh_delay = cache_mixin._LOCK_REFRESH_DELAY
+        cache_mixin._LOCK_REFRESH_DELAY = .01
+        try:
+            stop = cache_mixin._start_lock_refresh(lock_filename)
+            time.sleep(.1)
+            stop.set()
+        finally:
+            cache_mixin._LOCK_REFRESH_DELAY = refresh_delay
+        assert_false(cache_mixin._lock_is_stale(lock_filename))
+        os.remove(lock_filename)
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+
+def test_cache_memory_tier():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        cache_mixin._memory_cache_clear()
+        mem = Memory(cachedir=temp_dir, verbose=0)
+        cached_f = cache_mixin.cache(f, mem, ref_memory_level=2)
+        # The in-memory tier is disabled by default
+        cached_f(np.ones(10) * 4)
+        assert_equal(len(cache_mixin._memory_cache), 0)
+
+        nilearn.cache_stats_reset()
+        nilearn.cache_memory_entries = 2
+        for x in (1, 2, 1, 3, 2, 1):
+            output = cached_f(np.ones(10) * x)
+            np.testing.assert_array_equal(output, np.ones(10) * x)
+            # Modifying an output does not modify the cached one
+            output += 1
+        stats = nilearn.cache_stats(cached_f.func_name)
+        assert_equal(stats['misses'], 3)
+        assert_equal(stats['memory_hits'], 1)
+        # 2 was evicted from the in-memory tier by 1 and 3, then 1 by 3
+        # and 2
+        assert_equal(stats['hits'], 2)
+        assert_equal(len(cache_mixin._memory_cache), 2)
+        assert_equal(cache_mixin._memory_cache_size, 2 * 80)
+        # Small arrays have a cheap key: the arguments are not hashed
+        for key in cache_mixin._memory_cache:
+            assert_equal(key[0], cached_f._func_dir)
+        assert_true(cache_mixin._cheap_key(1) != cache_mixin._cheap_key(1.))
+        assert_raises(cache_mixin._NoCheapKey, cache_mixin._cheap_key,
+                      np.ones(10000))
+
+        # Outputs larger than the in-memory tier are not kept
+        nilearn.cache_memory_bytes = 100
+        cached_f(np.ones(100))
+        assert_equal(cache_mixin._memory_cache_size, 2 * 80)
+    finally:
+        nilearn.cache_memory_entries = 0
+        nilearn.cache_memory_bytes = 50e6
+        cache_mixin._memory_cache_clear()
+        nilearn.cache_stats_reset()
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
@@ -147,6 +147,76 @@ def test_apply_mask():
                   Nifti1Image(data, affine), mask_img)
 
 
+def test_apply_mask_scaled_data():
+    # Scaling of integer data is applied when masking
+    rng = np.random.RandomState(42)
+    shape = (6, 7, 8)
+    affine = np.eye(4)
+    mask = np.zeros(shape, dtype=np.int8)
+    mask[2:5, 2:5, 2:5] = 1
+    mask_img = Nifti1Image(mask, affine)
+    imgs = []
+    expected = []
+    for slope, inter in ((2., 1.), (.5, -3.)):
+        data = rng.randint(0, 1000, size=shape).astype(np.int16)
+        img = Nifti1Image(data, affine)
+        img.get_header().set_slope_inter(slope, inter)
+        imgs.append(img)
+        expected.append(slope * data[mask.astype(bool)] + inter)
+    expected = np.array(expected)
+
+    with write_tmp_imgs(*imgs) as filenames:
+        series = masking.apply_mask(filenames, mask_img)
+        assert_equal(series.dtype, np.float32)
+        np.testing.assert_array_almost_equal(series, expected)
+        # Same result with smoothing disabled and enabled
+        smoothed = masking.apply_mask(filenames, mask_img,
+                                      smoothing_fwhm=1e-10)
+        np.testing.assert_array_almost_equal(smoothed, expected, decimal=3)
+
+    # A scaled 4D file gives the float64 values of get_data()
+    data = rng.randint(0, 1000, size=shape + (2, )).astype(np.int16)
+    img = Nifti1Image(data, affine)
+    img.get_header().set_slope_inter(.5, -3.)
+    with write_tmp_imgs(img) as filename:
+        for smoothing_fwhm in (None, 1e-10):
+            series = masking.apply_mask(filename, mask_img,
+                                        smoothing_fwhm=smoothing_fwhm)
+            assert_equal(series.dtype, np.float64)
+            np.testing.assert_array_almost_equal(
+                series, .5 * data[mask.astype(bool)].T - 3., decimal=3)
+
+
+def test_apply_mask_masked_smoothing():
+    from ..image.image import _smooth_array
+    rng = np.random.RandomState(42)
+    shape = (30, 31, 32)
+    affine = np.diag((2., 1., 1.5, 1.))
+    data = rng.rand(*(shape + (3, )))
+    # The values out of the mask are ignored
+    data[:10] = np.nan
+    mask = np.zeros(shape, dtype=np.int8)
+    mask[12:16, 5:9, 20:26] = 1
+    mask[14, 8:12, 20] = 1
+    mask_img = Nifti1Image(mask, affine)
+    mask = mask.astype(bool)
+
+    series = masking.apply_mask(Nifti1Image(data, affine), mask_img,
+                                smoothing_fwhm=4, masked_smoothing=True)
+    # Normalized smoothing of the whole field of view
+    masked_data = np.where(mask[..., np.newaxis], data, 0)
+    expected = (_smooth_array(masked_data, affine, fwhm=4)[mask]
+                / _smooth_array(mask.astype(float), affine,
+                                fwhm=4)[mask][:, np.newaxis]).T
+    np.testing.assert_array_almost_equal(series, expected)
+
+    # No attenuation at the edges of the mask
+    series = masking.apply_mask(Nifti1Image(np.ones(shape + (2, )), affine),
+                                mask_img, smoothing_fwhm=4,
+                                masked_smoothing=True)
+    np.testing.assert_array_almost_equal(series, 1)
+
+
 def test_unmask():
     # A delta in 3D
     shape = (10, 20, 30, 40)
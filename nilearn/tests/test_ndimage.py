@@ -7,7 +7,10 @@ from nose.tools import assert_raises
 
 import numpy as np
 
-from nilearn._utils.ndimage import largest_connected_component
+from scipy import ndimage
+
+from nilearn._utils.ndimage import largest_connected_component, \
+     connected_components
 
 
 def test_largest_cc():
@@ -20,3 +23,27 @@ def test_largest_cc():
     b = a.copy()
     b[5, 5, 5] = 1
     np.testing.assert_equal(a, largest_connected_component(b))
+
+
+def test_connected_components():
+    rng = np.random.RandomState(42)
+    a = np.zeros((20, 21, 22), dtype=np.bool)
+    a[3:-4, 2:-3, 5:-2] = rng.rand(13, 16, 15) > .7
+    labels, sizes, slices, centroids = connected_components(a)
+    true_labels, label_nb = ndimage.label(a)
+    # Same labeling as on the whole array
+    np.testing.assert_equal(labels, true_labels)
+    np.testing.assert_equal(len(sizes), label_nb)
+    np.testing.assert_equal(sizes, ndimage.sum(a, true_labels,
+                                               range(1, label_nb + 1)))
+    np.testing.assert_equal(slices, ndimage.find_objects(true_labels))
+    np.testing.assert_array_almost_equal(
+        centroids, ndimage.center_of_mass(a, true_labels,
+                                          range(1, label_nb + 1)))
+
+    labels, sizes, slices, centroids = connected_components(
+        np.zeros((5, 6, 7)))
+    np.testing.assert_equal(labels, 0)
+    np.testing.assert_equal(len(sizes), 0)
+    np.testing.assert_equal(len(slices), 0)
+    np.testing.assert_equal(centroids.shape, (0, 3))
@@ -21,6 +21,7 @@ from nibabel import Nifti1Image
 
 from nilearn import _utils
 from nilearn._utils import testing
+from nilearn._utils import niimg_conversions
 
 
 class PhonyNiimage:
@@ -131,3 +132,82 @@ def test_concat_niimgs():
     finally:
         _remove_if_exists(tmpimg1)
         _remove_if_exists(tmpimg2)
+
+
+def test_concat_niimgs_lazy_scaling():
+    shape = (5, 6, 7)
+    affine = np.eye(4)
+    rng = np.random.RandomState(0)
+    filenames = []
+    expected = []
+    try:
+        for slope, inter in ((2., 1.), (.5, -3.), (1., 0.)):
+            data = rng.randint(-100, 100, size=shape).astype(np.int16)
+            niimg = Nifti1Image(data, affine)
+            niimg.get_header().set_slope_inter(slope, inter)
+            _, filename = tempfile.mkstemp(suffix='.nii')
+            nibabel.save(niimg, filename)
+            filenames.append(filename)
+            expected.append(slope * data + inter)
+        expected = np.concatenate([e[..., np.newaxis] for e in expected],
+                                  axis=-1)
+
+        concatenated = _utils.concat_niimgs(filenames, dtype=None)
+        stored, slopes, inters = \
+            niimg_conversions._unscaled_data(concatenated)
+        # Data is kept in its stored type
+        assert_equal(stored.dtype, np.int16)
+        np.testing.assert_array_equal(slopes, [2., .5, 1.])
+        np.testing.assert_array_equal(inters, [1., -3., 0.])
+        # But scaled values are returned by get_data
+        np.testing.assert_array_almost_equal(concatenated.get_data(),
+                                             expected)
+        assert_equal(concatenated.get_data().dtype, np.float32)
+        np.testing.assert_array_almost_equal(
+            concatenated.dataobj[1:3, ..., 1], expected[1:3, ..., 1])
+
+        # check_niimgs uses lazy scaling
+        checked = _utils.check_niimgs(filenames)
+        assert_equal(niimg_conversions._unscaled_data(checked)[0].dtype,
+                     np.int16)
+
+        # Default behavior is unchanged
+        concatenated = _utils.concat_niimgs(filenames)
+        assert_equal(niimg_conversions._unscaled_data(concatenated)[1],
+                     None)
+        np.testing.assert_array_almost_equal(concatenated.get_data(),
+                                             expected)
+    finally:
+        for filename in filenames:
+            _remove_if_exists(filename)
+
+
+
+def test_lazy_scaling_resample():
+    from nilearn.image import resample_img
+    shape = (5, 6, 7)
+    rng = np.random.RandomState(0)
+    filenames = []
+    try:
+        for slope in (2., .5):
+            data = rng.randint(-100, 100, size=shape).astype(np.int16)
+            niimg = Nifti1Image(data, np.eye(4))
+            niimg.get_header().set_slope_inter(slope, 1.)
+            _, filename = tempfile.mkstemp(suffix='.nii')
+            nibabel.save(niimg, filename)
+            filenames.append(filename)
+
+        checked = _utils.check_niimgs(filenames)
+        resampled = resample_img(checked, target_affine=2 * np.eye(3),
+                                 interpolation='nearest')
+        # The scaled data is not kept next to the stored one
+        assert_true(checked._data_cache is None)
+        # The proxy honours the requested dtype
+        data = np.asarray(checked.dataobj, dtype=np.float64)
+        assert_equal(data.dtype, np.float64)
+        np.testing.assert_array_almost_equal(data, checked.get_data())
+        np.testing.assert_array_almost_equal(
+            resampled.get_data()[:3, :3, :4], data[::2, ::2, ::2])
+    finally:
+        for filename in filenames:
+            _remove_if_exists(filename)
@@ -183,6 +183,41 @@ def test_signals_extraction_with_labels():
                   good_labels_img, mask_img=bad_mask2_img)
 
 
+def test_signals_to_img_labels_mapping():
+    """Test signals_to_img_labels with sparse labels, a background label
+    and both memory orders against a voxel by voxel reference."""
+    rand_gen = np.random.RandomState(0)
+    shape = (7, 8, 9)
+    n_instants = 5
+    # Unsorted, non-contiguous labels, 3 being the background
+    labels_data = rand_gen.permutation([3, 10, -2, 7, 42])[
+        rand_gen.randint(5, size=shape)]
+    labels_img = nibabel.Nifti1Image(labels_data, np.eye(4))
+    mask_data = (rand_gen.rand(*shape) > .3).astype(np.int8)
+    mask_img = nibabel.Nifti1Image(mask_data, np.eye(4))
+    labels = [-2, 7, 10, 42]
+    signals = rand_gen.randn(n_instants, len(labels)).astype(np.float32)
+
+    expected = np.zeros(shape + (n_instants, ), dtype=np.float32)
+    for n, label in enumerate(labels):
+        expected[np.logical_and(labels_data == label, mask_data), :] = \
+            signals[:, n]
+
+    for order in ("F", "C"):
+        data_img = region.signals_to_img_labels(
+            signals, labels_img, mask_img=mask_img, background_label=3,
+            order=order)
+        data = data_img.get_data()
+        assert_true(data.dtype == np.float32)
+        assert_true(data.flags[order + "_CONTIGUOUS"])
+        np.testing.assert_array_equal(data, expected)
+
+        # No scans
+        data_img = region.signals_to_img_labels(
+            signals[:0], labels_img, mask_img=mask_img, order=order)
+        assert_true(data_img.shape == shape + (0, ))
+
+
 def test_signal_extraction_with_maps():
     shape = (10, 11, 12)
     n_regions = 9